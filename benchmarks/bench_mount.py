@@ -0,0 +1,105 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli"))
+
+from constants import CLONE_NEWNS  # noqa: E402
+from functions import FuncTools, libc, overlay_options  # noqa: E402
+
+tools = FuncTools()
+
+
+def subprocess_mount(source, target, fs_type, options=None):
+    cmd = ["mount"]
+    if options:
+        cmd.extend(["-o", options])
+    if fs_type:
+        cmd.extend(["-t", fs_type])
+    cmd.extend([source, target])
+    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def subprocess_rprivate():
+    subprocess.run(["mount", "--make-rprivate", "/"], check=True)
+
+
+def container_mounts(mount, make_rprivate, root):
+    # The same sequence contain()/_create_mount() perform for one container.
+    lower, upper, work, rootfs = (
+        os.path.join(root, d) for d in ("lower", "upper", "work", "rootfs")
+    )
+    make_rprivate()
+    mount("overlay", rootfs, "overlay", overlay_options(lower, upper, work))
+    mount("proc", os.path.join(rootfs, "proc"), "proc")
+    mount("sysfs", os.path.join(rootfs, "sys"), "sysfs")
+    mount("tmpfs", os.path.join(rootfs, "dev"), "tmpfs", "mode=755,nosuid,strictatime")
+    os.makedirs(os.path.join(rootfs, "dev", "pts"))
+    mount("devpts", os.path.join(rootfs, "dev", "pts"), "devpts", "gid=5,mode=620")
+    mount(os.path.join(root, "sock"), os.path.join(rootfs, "sock"), None, "bind")
+
+
+def teardown(root):
+    rootfs = os.path.join(root, "rootfs")
+    for d in ("sock", "dev/pts", "dev", "sys", "proc", ""):
+        if libc.umount2(os.path.join(rootfs, d).encode(), 2) != 0:
+            raise OSError(f"umount {d} failed")
+    shutil.rmtree(os.path.join(root, "upper"))
+    shutil.rmtree(os.path.join(root, "work"))
+    os.makedirs(os.path.join(root, "upper"))
+    os.makedirs(os.path.join(root, "work"))
+
+
+def prepare(root):
+    lower = os.path.join(root, "lower")
+    for d in ("proc", "sys", "dev"):
+        os.makedirs(os.path.join(lower, d))
+    open(os.path.join(lower, "sock"), "w").close()
+    for d in ("upper", "work", "rootfs"):
+        os.makedirs(os.path.join(root, d))
+    open(os.path.join(root, "sock"), "w").close()
+
+
+def measure(name, mount, make_rprivate, root, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        container_mounts(mount, make_rprivate, root)
+        samples.append(time.perf_counter() - start)
+        teardown(root)
+    samples.sort()
+    print(
+        f"{name:<12} p50={samples[len(samples) // 2] * 1000:.2f}ms "
+        f"p99={samples[int(len(samples) * 0.99) - 1] * 1000:.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/bin/mount vs mount(2)")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        sys.exit("must run as root")
+    tools.unshare(CLONE_NEWNS)
+    root = tempfile.mkdtemp()
+    try:
+        prepare(root)
+        measure("subprocess", subprocess_mount, subprocess_rprivate, root, args.iterations)
+        measure(
+            "mount(2)",
+            tools.mount,
+            lambda: tools.make_rprivate("/"),
+            root,
+            args.iterations,
+        )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
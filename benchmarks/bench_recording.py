@@ -0,0 +1,216 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "container_backend"
+)
+sys.path.insert(0, BACKEND_DIR)
+
+from container.recording import Recorder  # noqa: E402
+
+# Each session is a real pty whose output is read with loop.add_reader, as in
+# views_terminal. A separate process writes the sessions' output, so the load
+# costs the event loop the same with and without recording. Echo latency is
+# measured on one extra session by writing a key to its master and waiting for
+# the line discipline's echo to come back through the loop.
+LINE = b"x" * 78 + b"\n"
+
+
+def load_process(slaves, probe_slave, lines_per_s):
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        # Keep the probe's input queue from filling up.
+        os.set_blocking(probe_slave, True)
+
+        def drain():
+            while True:
+                os.read(probe_slave, 4096)
+
+        threading.Thread(target=drain, daemon=True).start()
+        interval = 0.01
+        per_tick = lines_per_s * interval
+        owed = 0.0
+        while True:
+            start = time.monotonic()
+            owed += per_tick
+            for _ in range(int(owed)):
+                try:
+                    os.write(random.choice(slaves), LINE)
+                except BlockingIOError:
+                    pass
+            owed -= int(owed)
+            time.sleep(max(0, interval - (time.monotonic() - start)))
+    finally:
+        os._exit(0)
+
+
+def distribution(values):
+    values = sorted(values)
+
+    def pct(q):
+        return values[max(0, math.ceil(q * len(values)) - 1)]
+
+    return {
+        "count": len(values),
+        "mean_ms": statistics.fmean(values) * 1000,
+        "p50_ms": pct(0.5) * 1000,
+        "p99_ms": pct(0.99) * 1000,
+        "max_ms": values[-1] * 1000,
+    }
+
+
+async def trial(args, recorder):
+    loop = asyncio.get_running_loop()
+    ptys = [os.openpty() for _ in range(args.sessions + 1)]
+    recordings = [
+        recorder.open(f"bench{i}") if recorder else None for i in range(len(ptys))
+    ]
+    received = [0]
+    echoed = asyncio.Event()
+
+    def on_output(i, master):
+        try:
+            data = os.read(master, 65536)
+        except OSError:
+            return
+        received[0] += len(data)
+        if recordings[i] is not None:
+            recordings[i].output(data)
+        if i == 0:
+            echoed.set()
+
+    for i, (master, slave) in enumerate(ptys):
+        os.set_blocking(master, False)
+        os.set_blocking(slave, False)
+        loop.add_reader(master, on_output, i, master)
+
+    probe = ptys[0][0]
+    slaves = [slave for _, slave in ptys[1:]]
+    pid = load_process(slaves, ptys[0][1], args.lines_per_s)
+    try:
+        await asyncio.sleep(1)
+        before = received[0]
+        latencies = []
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            echoed.clear()
+            t = time.perf_counter()
+            os.write(probe, b"k")
+            if recordings[0] is not None:
+                recordings[0].input(b"k")
+            await asyncio.wait_for(echoed.wait(), 5)
+            latencies.append(time.perf_counter() - t)
+            await asyncio.sleep(args.probe_interval)
+        elapsed = time.perf_counter() - start
+        throughput = (received[0] - before) / elapsed
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        for master, slave in ptys:
+            loop.remove_reader(master)
+        for recording in recordings:
+            if recording is not None:
+                recording.close()
+        for master, slave in ptys:
+            os.close(master)
+            os.close(slave)
+    return {"echo": distribution(latencies), "output_bytes_per_s": throughput}
+
+
+def directory_size(path):
+    total = 0
+    files = 0
+    for name in os.listdir(path):
+        total += os.path.getsize(os.path.join(path, name))
+        files += 1
+    return total, files
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=BACKEND_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="echo latency with recording")
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument(
+        "--lines-per-s", type=int, default=5000, help="output, all sessions"
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--probe-interval", type=float, default=0.01)
+    parser.add_argument("--max-bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--output", "-o", help="write results as JSON")
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < 3 * args.sessions + 64:
+        sys.exit(f"need {3 * args.sessions + 64} file descriptors, limit is {hard}")
+
+    workdir = tempfile.mkdtemp()
+    try:
+        results = {"off": asyncio.run(trial(args, None))}
+        recorder = Recorder(workdir, args.max_bytes)
+        results["on"] = asyncio.run(trial(args, recorder))
+        recorder.close()
+        size, files = directory_size(workdir)
+        results["on"]["recorded_bytes"] = size
+        results["on"]["recorded_files"] = files
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    off, on = results["off"]["echo"], results["on"]["echo"]
+    for label in ("off", "on"):
+        r = results[label]
+        print(
+            f"recording {label:<3}: echo p50={r['echo']['p50_ms']:.3f}ms "
+            f"p99={r['echo']['p99_ms']:.3f}ms, "
+            f"{r['output_bytes_per_s'] / 1e6:.2f} MB/s of output"
+        )
+    print(
+        f"added: p50 {on['p50_ms'] - off['p50_ms']:+.3f}ms, "
+        f"p99 {on['p99_ms'] - off['p99_ms']:+.3f}ms; "
+        f"{results['on']['recorded_files']} files, "
+        f"{results['on']['recorded_bytes'] / 1e6:.1f} MB after compression"
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "timestamp": time.time(),
+                    "config": vars(args),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CLI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli")
+sys.path.insert(0, CLI_DIR)
+
+import tracing  # noqa: E402
+
+IMAGE_NAME = "benchtrue"
+ROOTFS_DIRS = ("proc", "sys", "dev", "etc", "tmp", "var/run")
+
+
+def _shared_libraries(binary):
+    # No registry needed: the image is /bin/true plus whatever ldd says it
+    # loads, so it builds offline from the host's own files.
+    output = subprocess.run(
+        ["ldd", binary], capture_output=True, text=True, check=False
+    ).stdout
+    libs = []
+    for line in output.splitlines():
+        for part in line.split():
+            if part.startswith("/") and os.path.exists(part):
+                libs.append(part)
+    return libs
+
+
+def make_image(image_dir):
+    path = os.path.join(image_dir, f"{IMAGE_NAME}.tar.gz")
+    true = shutil.which("true")
+    with tarfile.open(path, "w:gz") as t:
+        for d in ROOTFS_DIRS:
+            info = tarfile.TarInfo(d)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            t.addfile(info)
+        for f in [true] + _shared_libraries(true):
+            t.add(os.path.realpath(f), arcname=f.lstrip("/"))
+        # Containers run /bin/true wherever the host keeps it.
+        if true != "/bin/true":
+            t.add(os.path.realpath(true), arcname="bin/true")
+    return path
+
+
+def run_container(i, image_dir, container_dir, trace_dir, env):
+    cmd = [
+        sys.executable,
+        os.path.join(CLI_DIR, "main.py"),
+        "run",
+        "--name",
+        f"bench{i}",
+        "--image-name",
+        IMAGE_NAME,
+        "--image-dir",
+        image_dir,
+        "--container-dir",
+        container_dir,
+        "--trace",
+        trace_dir,
+        "/bin/true",
+    ]
+    start = time.perf_counter()
+    result = subprocess.run(cmd, capture_output=True, text=True, env=env)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0 or "exited with status 0" not in result.stdout:
+        raise RuntimeError(
+            f"container {i} failed:\n{result.stdout[-2000:]}{result.stderr[-2000:]}"
+        )
+    return elapsed
+
+
+def distribution(values):
+    values = sorted(values)
+
+    def pct(q):
+        return values[max(0, math.ceil(q * len(values)) - 1)]
+
+    return {
+        "count": len(values),
+        "mean_ms": statistics.fmean(values) * 1000,
+        "p50_ms": pct(0.5) * 1000,
+        "p90_ms": pct(0.9) * 1000,
+        "p99_ms": pct(0.99) * 1000,
+        "max_ms": values[-1] * 1000,
+    }
+
+
+def measure(label, count, concurrency, cold, image_dir, workdir, env):
+    trace_dir = os.path.join(workdir, f"traces-{label}")
+    container_dir = os.path.join(workdir, f"containers-{label}")
+    os.makedirs(trace_dir)
+    os.makedirs(container_dir)
+    cache_dir = os.path.join(image_dir, ".cache")
+
+    def one(i):
+        return run_container(i, image_dir, container_dir, trace_dir, env)
+
+    start = time.perf_counter()
+    if cold:
+        # Every run finds an empty image cache, so they can't overlap.
+        latencies = []
+        for i in range(count):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            latencies.append(one(i))
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(one, range(count)))
+    wall = time.perf_counter() - start
+
+    traces = [
+        os.path.join(trace_dir, f) for f in os.listdir(trace_dir) if f.endswith(".json")
+    ]
+    phases = {
+        name: {"count": n, "p50_ms": p50, "p99_ms": p99}
+        for name, n, p50, p99 in tracing.summarize(traces)
+    }
+    return {
+        "containers": count,
+        "concurrency": 1 if cold else concurrency,
+        "throughput_per_s": count / wall,
+        "end_to_end": distribution(latencies),
+        "phases": phases,
+    }
+
+
+def print_result(label, result, baseline=None):
+    e2e = result["end_to_end"]
+    print(
+        f"\n{label}: {result['containers']} containers, concurrency "
+        f"{result['concurrency']}, {result['throughput_per_s']:.1f}/s"
+    )
+    line = f"  end-to-end p50={e2e['p50_ms']:.1f}ms p99={e2e['p99_ms']:.1f}ms"
+    if baseline:
+        old = baseline["end_to_end"]["p50_ms"]
+        line += f" (baseline p50={old:.1f}ms, {e2e['p50_ms'] / old:.2f}x)"
+    print(line)
+    for name, phase in result["phases"].items():
+        line = f"  {name:<24} p50={phase['p50_ms']:8.2f}ms p99={phase['p99_ms']:8.2f}ms"
+        old = (baseline or {}).get("phases", {}).get(name)
+        if old and old["p50_ms"]:
+            line += f"  ({phase['p50_ms'] / old['p50_ms']:.2f}x)"
+        print(line)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=CLI_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="container startup latency")
+    parser.add_argument("--containers", "-n", type=int, default=50)
+    parser.add_argument("--concurrency", "-j", type=int, default=1)
+    parser.add_argument("--cold", type=int, default=5, help="cold-cache runs")
+    parser.add_argument("--netpool-size", type=int, default=None)
+    parser.add_argument("--output", "-o", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--workdir", default=None)
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        sys.exit("must run as root")
+
+    env = dict(os.environ)
+    if args.netpool_size is not None:
+        env["CONTAINERR_NETPOOL_SIZE"] = str(args.netpool_size)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        image_dir = os.path.join(workdir, "images")
+        os.makedirs(image_dir)
+        make_image(image_dir)
+
+        results = {}
+        if args.cold:
+            results["cold"] = measure("cold", args.cold, 1, True, image_dir, workdir, env)
+        # One untimed run so the warm numbers never include the first extraction.
+        run_container("warmup", image_dir, os.path.join(workdir, "warmup"), workdir, env)
+        results["warm"] = measure(
+            "warm", args.containers, args.concurrency, False, image_dir, workdir, env
+        )
+        for label, result in results.items():
+            print_result(label, result, (baseline or {}).get(label))
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(
+                    {
+                        "commit": git_commit(),
+                        "timestamp": time.time(),
+                        "config": vars(args),
+                        "results": results,
+                    },
+                    f,
+                    indent=2,
+                )
+            print(f"\nwrote {args.output}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
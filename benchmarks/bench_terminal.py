@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import codecs
+import http.cookiejar
+import json
+import math
+import os
+import re
+import statistics
+import subprocess
+import time
+import urllib.parse
+import urllib.request
+import zlib
+
+# Needs a running server (uvicorn container_backend.asgi:application) and the
+# python-socketio asyncio client (pip install "python-socketio[asyncio_client]").
+import socketio
+
+FLOOD_COMMAND = "yes 0123456789abcdefghijklmnopqrstuvwxyz\n"
+PROBE_KEYS = "abcdefghijklmnopqrstuvwxyz"
+# json is the pty_output/pty_input path; binary sends raw pty_data frames.
+TRANSPORTS = {
+    "json": {},
+    "binary": {"binary": True},
+    "deflate": {"binary": True, "deflate": True},
+}
+FRAME_DEFLATE = 1
+
+
+def open_terminal(url, name, image):
+    # Goes through the create form like a browser, so the server hands back a
+    # terminal token for a fresh container.
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    form = urllib.parse.urlencode({"name": name, "image_name": image}).encode()
+    with opener.open(f"{url}/containers/create/", form) as response:
+        page = response.read().decode("utf-8")
+    match = re.search(r'token: "([^"]+)"', page)
+    if not match:
+        raise RuntimeError(f"no terminal token for {name}")
+    return match.group(1)
+
+
+class Terminal:
+    # With watch set this is a read-only viewer of another session; acks=False
+    # makes a client that never keeps up.
+    def __init__(self, url, token, transport, watch=None, acks=True):
+        self.url = url
+        self.token = token
+        self.transport = transport
+        self.watch = watch
+        self.acks = acks
+        self.watch_key = asyncio.get_running_loop().create_future()
+        self.client = socketio.AsyncClient(reconnection=False)
+        # Terminal bytes delivered, and payload bytes it took to deliver them.
+        self.received = 0
+        self.wire = 0
+        self.messages = 0
+        self.output = asyncio.Event()
+        self.text = ""
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.client.on("pty_output", self.on_output)
+        self.client.on("pty_data", self.on_data)
+        self.client.on("pty_session", self.on_session)
+
+    async def on_session(self, message):
+        if not self.watch_key.done():
+            self.watch_key.set_result(message["watch"])
+
+    def record(self, text, wire):
+        self.wire += wire
+        self.messages += 1
+        self.text = (self.text + text)[-4096:]
+        self.output.set()
+
+    async def on_output(self, message):
+        self.received += message["bytes"]
+        self.record(message["output"], len(json.dumps(message)))
+        if self.acks:
+            await self.client.emit("pty_ack", {"bytes": message["bytes"]})
+
+    async def on_data(self, frame):
+        data = frame[1:]
+        if frame[0] & FRAME_DEFLATE:
+            data = zlib.decompress(data)
+        self.received += len(data)
+        self.record(self.decoder.decode(data), len(frame))
+        if self.acks:
+            await self.client.emit("pty_ack", {"bytes": len(data)})
+
+    async def connect(self):
+        if self.watch:
+            auth = dict(TRANSPORTS[self.transport], watch=self.watch)
+        else:
+            auth = dict(TRANSPORTS[self.transport], token=self.token)
+        await self.client.connect(self.url, auth=auth, transports=["websocket"])
+
+    async def send(self, data):
+        if self.transport == "json":
+            await self.client.emit("pty_input", {"input": data})
+        else:
+            await self.client.emit("pty_data", data.encode("utf-8"))
+
+    async def wait_for(self, text, timeout):
+        deadline = time.perf_counter() + timeout
+        while text not in self.text:
+            self.output.clear()
+            await asyncio.wait_for(self.output.wait(), deadline - time.perf_counter())
+
+    async def close(self):
+        await self.client.disconnect()
+
+
+def cpu_seconds(pid):
+    # utime + stime of the server process, if we were told which one it is.
+    if pid is None:
+        return 0.0
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def distribution(values):
+    values = sorted(values)
+
+    def pct(q):
+        return values[max(0, math.ceil(q * len(values)) - 1)]
+
+    return {
+        "count": len(values),
+        "mean_ms": statistics.fmean(values) * 1000,
+        "p50_ms": pct(0.5) * 1000,
+        "p99_ms": pct(0.99) * 1000,
+        "max_ms": values[-1] * 1000,
+    }
+
+
+async def echo_latencies(probe, duration):
+    latencies = []
+    end = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < end:
+        key = PROBE_KEYS[i % len(PROBE_KEYS)]
+        probe.text = ""
+        start = time.perf_counter()
+        await probe.send(key)
+        await probe.wait_for(key, 10)
+        latencies.append(time.perf_counter() - start)
+        i += 1
+        if i % 50 == 0:
+            # Clear the line so the probe's shell input stays short.
+            await probe.send("\x15")
+        await asyncio.sleep(0.02)
+    return latencies
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    tokens = [
+        await loop.run_in_executor(
+            None, open_terminal, args.url, f"benchterm{i}", args.image
+        )
+        for i in range(args.flooders + 1)
+    ]
+    terminals = [Terminal(args.url, token, args.transport) for token in tokens]
+    await asyncio.gather(*(t.connect() for t in terminals))
+    probe, flooders = terminals[0], terminals[1:]
+    try:
+        await asyncio.sleep(args.settle)
+        idle = await echo_latencies(probe, min(args.duration, 5))
+
+        for t in flooders:
+            await t.send(FLOOD_COMMAND)
+        await asyncio.sleep(1)
+        before = [(t.received, t.wire, t.messages) for t in flooders]
+        cpu_before = cpu_seconds(args.server_pid)
+        start = time.perf_counter()
+        flooded = await echo_latencies(probe, args.duration)
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds(args.server_pid) - cpu_before
+        received = [t.received - b[0] for t, b in zip(flooders, before)]
+        wire = sum(t.wire - b[1] for t, b in zip(flooders, before))
+        sent = sum(t.messages - b[2] for t, b in zip(flooders, before))
+        for t in flooders:
+            await t.send("\x03")
+    finally:
+        await asyncio.gather(*(t.close() for t in terminals), return_exceptions=True)
+
+    total = sum(received)
+    result = {
+        "transport": args.transport,
+        "echo_idle": distribution(idle),
+        "echo_flooded": distribution(flooded),
+        "flood_mb_per_s": total / elapsed / 1e6,
+        "flood_mb_per_s_per_session": [r / elapsed / 1e6 for r in received],
+        "avg_message_bytes": total / max(1, sent),
+        # Payload bytes on the socket per terminal byte delivered.
+        "wire_ratio": wire / max(1, total),
+    }
+    if args.server_pid is not None:
+        result["server_cpu_s_per_mb"] = cpu / max(1e-9, total / 1e6)
+        result["server_cpu_per_session"] = cpu / elapsed / max(1, len(flooders))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="terminal throughput under flood")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--image", default="ubuntu")
+    parser.add_argument("--flooders", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--transport", choices=sorted(TRANSPORTS), default="json")
+    parser.add_argument("--server-pid", type=int, help="sample this process's CPU")
+    parser.add_argument("--settle", type=float, default=3, help="wait for shells")
+    parser.add_argument("--output", "-o", help="write results as JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    for label in ("echo_idle", "echo_flooded"):
+        d = result[label]
+        print(f"{label:<14} p50={d['p50_ms']:.2f}ms p99={d['p99_ms']:.2f}ms")
+    print(
+        f"flood          {result['flood_mb_per_s']:.1f} MB/s over "
+        f"{args.flooders} sessions, {result['avg_message_bytes']:.0f} B/message, "
+        f"{result['wire_ratio']:.2f} wire bytes per byte ({args.transport})"
+    )
+    if "server_cpu_s_per_mb" in result:
+        print(
+            f"server cpu     {result['server_cpu_s_per_mb'] * 1000:.1f} ms/MB, "
+            f"{result['server_cpu_per_session'] * 100:.1f}% of a core per session"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "timestamp": time.time(),
+                    "config": vars(args),
+                    "results": result,
+                },
+                f,
+                indent=2,
+            )
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cli"))
+
+from unpack import DEFAULT_WORKERS, unpack  # noqa: E402
+
+
+def make_image(path, files, dirs, size):
+    payload = os.urandom(size)
+    with tarfile.open(path, "w:gz") as t:
+        for d in range(dirs):
+            info = tarfile.TarInfo(f"usr/share/d{d}")
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            t.addfile(info)
+        for i in range(files):
+            info = tarfile.TarInfo(f"usr/share/d{i % dirs}/f{i}")
+            info.size = size
+            info.mode = 0o644
+            t.addfile(info, io.BytesIO(payload))
+        info = tarfile.TarInfo("dev/null")
+        info.type = tarfile.CHRTYPE
+        info.devmajor, info.devminor = 1, 3
+        t.addfile(info)
+        info = tarfile.TarInfo("usr/share/link")
+        info.type = tarfile.SYMTYPE
+        info.linkname = "d0/f0"
+        t.addfile(info)
+
+
+def extract_getmembers(image_path, dest):
+    with tarfile.open(image_path) as t:
+        members = [
+            m
+            for m in t.getmembers()
+            if m.type not in (tarfile.CHRTYPE, tarfile.BLKTYPE)
+        ]
+        t.extractall(dest, members=members)
+
+
+def timed(fn, image_path, workdir, repeat):
+    best = None
+    for _ in range(repeat):
+        dest = tempfile.mkdtemp(dir=workdir)
+        start = time.perf_counter()
+        fn(image_path, dest)
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(dest)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tarfile.extractall vs unpack")
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--dirs", type=int, default=200)
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="writer threads, 0 for serial (default depends on the CPU count)",
+    )
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        image_path = os.path.join(workdir, "synthetic.tar.gz")
+        make_image(image_path, args.files, args.dirs, args.size)
+        print(f"{os.cpu_count()} CPUs, {args.workers} writer threads")
+        print(
+            f"image: {args.files} files x {args.size} bytes, "
+            f"{os.path.getsize(image_path)} bytes compressed"
+        )
+        baseline = timed(extract_getmembers, image_path, workdir, args.repeat)
+        streamed = timed(
+            lambda src, dest: unpack(src, dest, workers=args.workers),
+            image_path,
+            workdir,
+            args.repeat,
+        )
+        print(f"getmembers + extractall: {baseline:.3f}s")
+        print(f"streaming unpack:        {streamed:.3f}s")
+        print(f"speedup:                 {baseline / streamed:.2f}x")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
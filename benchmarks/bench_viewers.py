@@ -0,0 +1,143 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_terminal import (  # noqa: E402
+    FLOOD_COMMAND,
+    Terminal,
+    cpu_seconds,
+    git_commit,
+    open_terminal,
+)
+
+CONNECT_BATCH = 50
+
+
+async def connect_all(terminals):
+    for i in range(0, len(terminals), CONNECT_BATCH):
+        await asyncio.gather(*(t.connect() for t in terminals[i : i + CONNECT_BATCH]))
+
+
+async def measure(owner, watch_key, count, args):
+    viewers = [
+        Terminal(args.url, None, args.transport, watch=watch_key) for _ in range(count)
+    ]
+    # One viewer that never acknowledges: it must not slow anyone else down.
+    slow = Terminal(args.url, None, args.transport, watch=watch_key, acks=False)
+    await connect_all(viewers + [slow])
+    try:
+        await asyncio.sleep(1)
+        await owner.send(FLOOD_COMMAND)
+        await asyncio.sleep(1)
+
+        everyone = [owner, slow] + viewers
+        before = [t.received for t in everyone]
+        cpu_before = cpu_seconds(args.server_pid)
+        start = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds(args.server_pid) - cpu_before
+        rates = [(t.received - b) / elapsed / 1e6 for t, b in zip(everyone, before)]
+
+        await owner.send("\x03")
+        await asyncio.sleep(1)
+    finally:
+        await asyncio.gather(
+            *(t.close() for t in viewers + [slow]), return_exceptions=True
+        )
+
+    owner_rate, slow_rate, viewer_rates = rates[0], rates[1], rates[2:]
+    result = {
+        "viewers": count,
+        "owner_mb_per_s": owner_rate,
+        "slow_viewer_mb_per_s": slow_rate,
+    }
+    if viewer_rates:
+        result["viewer_mb_per_s_median"] = statistics.median(viewer_rates)
+        result["viewer_mb_per_s_min"] = min(viewer_rates)
+    if args.server_pid is not None:
+        result["server_cpu"] = cpu / elapsed
+    return result
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    token = await loop.run_in_executor(
+        None, open_terminal, args.url, "benchwatch", args.image
+    )
+    owner = Terminal(args.url, token, args.transport)
+    await owner.connect()
+    try:
+        watch_key = await asyncio.wait_for(owner.watch_key, 10)
+        await asyncio.sleep(args.settle)
+        results = []
+        for count in args.viewers:
+            result = await measure(owner, watch_key, count, args)
+            print_result(result, results[0] if results else None)
+            results.append(result)
+        return results
+    finally:
+        await owner.close()
+
+
+def print_result(result, base):
+    line = (
+        f"{result['viewers']:>4} viewers: owner {result['owner_mb_per_s']:6.2f} MB/s"
+    )
+    if "viewer_mb_per_s_median" in result:
+        line += (
+            f", viewers median {result['viewer_mb_per_s_median']:6.2f}"
+            f" min {result['viewer_mb_per_s_min']:6.2f} MB/s"
+        )
+    line += f", slow viewer {result['slow_viewer_mb_per_s']:6.2f} MB/s"
+    if "server_cpu" in result:
+        line += f", server {result['server_cpu'] * 100:5.1f}% cpu"
+        if base is not None and result["viewers"] > base["viewers"]:
+            per_viewer = (result["server_cpu"] - base["server_cpu"]) / (
+                result["viewers"] - base["viewers"]
+            )
+            result["server_cpu_per_viewer"] = per_viewer
+            line += f" ({per_viewer * 100:.2f}% per viewer)"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="read-only viewer fan-out cost")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--image", default="ubuntu")
+    parser.add_argument(
+        "--viewers",
+        type=lambda v: [int(n) for n in v.split(",")],
+        default=[0, 10, 50, 100, 200],
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--transport", choices=["binary", "deflate"], default="binary")
+    parser.add_argument("--server-pid", type=int, help="sample this process's CPU")
+    parser.add_argument("--settle", type=float, default=3, help="wait for the shell")
+    parser.add_argument("--output", "-o", help="write results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "timestamp": time.time(),
+                    "config": vars(args),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,48 @@
 import sys
 import os
-import subprocess
 import ctypes
-from constants import CLONE_NEWNET, NR_pivot_root
+import errno
+import fcntl
+import signal
+import struct
+import threading
+import time
+import traceback
+from constants import (
+    CLONE_NEWNET,
+    CLONE_PIDFD,
+    LO_FLAGS_AUTOCLEAR,
+    LO_FLAGS_READ_ONLY,
+    LOOP_CONFIGURE,
+    LOOP_CTL_GET_FREE,
+    LOOP_SET_FD,
+    LOOP_SET_STATUS64,
+    MS_BIND,
+    MS_NOATIME,
+    MS_NODEV,
+    MS_NODIRATIME,
+    MS_NOEXEC,
+    MS_NOSUID,
+    MS_PRIVATE,
+    MS_RDONLY,
+    MS_REC,
+    MS_RELATIME,
+    MS_REMOUNT,
+    MS_STRICTATIME,
+    NR_clone,
+    NR_clone3,
+    NR_pivot_root,
+)
 
 libc = ctypes.CDLL("libc.so.6", use_errno=True)
+libc.mount.restype = ctypes.c_int
+libc.mount.argtypes = [
+    ctypes.c_char_p,
+    ctypes.c_char_p,
+    ctypes.c_char_p,
+    ctypes.c_ulong,
+    ctypes.c_char_p,
+]
 clone = libc.clone
 clone.restype = ctypes.c_int
 clone.argtypes = [
@@ -14,13 +52,84 @@ clone.argtypes = [
     ctypes.c_void_p,
 ]
 
+# The raw clone syscalls must run with the GIL held, between the same
+# PyOS_*Fork hooks os.fork() uses, so they go through a PyDLL handle.
+_libc_gil = ctypes.PyDLL("libc.so.6", use_errno=True)
+_libc_gil.syscall.restype = ctypes.c_long
+
+
+class CloneArgs(ctypes.Structure):
+    # struct clone_args, CLONE_ARGS_SIZE_VER0
+    _fields_ = [
+        ("flags", ctypes.c_uint64),
+        ("pidfd", ctypes.c_uint64),
+        ("child_tid", ctypes.c_uint64),
+        ("parent_tid", ctypes.c_uint64),
+        ("exit_signal", ctypes.c_uint64),
+        ("stack", ctypes.c_uint64),
+        ("stack_size", ctypes.c_uint64),
+        ("tls", ctypes.c_uint64),
+    ]
+
+
+# Generic mount(8)-style options that map to mount(2) flags; everything else is
+# passed through to the filesystem as data.
+MOUNT_FLAGS = {
+    "ro": MS_RDONLY,
+    "rw": 0,
+    "nosuid": MS_NOSUID,
+    "nodev": MS_NODEV,
+    "noexec": MS_NOEXEC,
+    "remount": MS_REMOUNT,
+    "bind": MS_BIND,
+    "rbind": MS_BIND | MS_REC,
+    "noatime": MS_NOATIME,
+    "nodiratime": MS_NODIRATIME,
+    "relatime": MS_RELATIME,
+    "strictatime": MS_STRICTATIME,
+}
+
+# struct loop_info64 up to and including lo_flags, then the name/key buffers.
+LOOP_INFO64 = struct.Struct("=5Q4I64s64s32s2Q")
+
+
+def _encode(value):
+    return value.encode("utf-8") if value is not None else None
+
+
+def parse_mount_options(options):
+    flags = 0
+    data = []
+    loop = False
+    for option in (options or "").split(","):
+        if not option:
+            continue
+        if option == "loop":
+            loop = True
+        elif option in MOUNT_FLAGS:
+            flags |= MOUNT_FLAGS[option]
+        else:
+            data.append(option)
+    return flags, ",".join(data) or None, loop
+
+
+def _escape_overlay_path(path):
+    return path.replace("\\", "\\\\").replace(":", "\\:").replace(",", "\\,")
+
+
+def overlay_options(lowerdir, upperdir, workdir):
+    # lowerdir may be a list (top layer first) or an already joined string.
+    if not isinstance(lowerdir, str):
+        lowerdir = ":".join(_escape_overlay_path(d) for d in lowerdir)
+    return "lowerdir={},upperdir={},workdir={}".format(
+        lowerdir, _escape_overlay_path(upperdir), _escape_overlay_path(workdir)
+    )
+
 
 class FuncTools:
     def pivot_root(self, new_root, put_old):
         new_root = new_root.encode("utf-8")
         put_old = put_old.encode("utf-8")
-        print(new_root)
-        print(put_old)
         result = libc.syscall(NR_pivot_root, new_root, put_old)
         if result != 0:
             print(f"pivot_root failed with error code {result}", file=sys.stderr)
@@ -36,6 +145,71 @@ class FuncTools:
             errno = ctypes.get_errno()
             raise OSError(errno, f"Failed to unshare: {os.strerror(errno)}")
 
+    def _raw_clone(self, flags, pidfd):
+        args = CloneArgs(
+            flags=flags,
+            pidfd=ctypes.addressof(pidfd) if flags & CLONE_PIDFD else 0,
+            exit_signal=signal.SIGCHLD,
+        )
+        pid = _libc_gil.syscall(
+            NR_clone3, ctypes.byref(args), ctypes.c_size_t(ctypes.sizeof(args))
+        )
+        if pid == -1 and ctypes.get_errno() in (errno.ENOSYS, errno.EPERM):
+            # No clone3 (or filtered by seccomp): the legacy syscall stores the
+            # pidfd through the parent_tid argument.
+            pid = _libc_gil.syscall(
+                NR_clone,
+                ctypes.c_ulong(flags | signal.SIGCHLD),
+                None,
+                ctypes.byref(pidfd) if flags & CLONE_PIDFD else None,
+                None,
+                None,
+            )
+        return pid
+
+    def clone(self, flags):
+        # Like os.fork(), but the child starts directly in new namespaces and the
+        # parent gets a pidfd for it. Returns (pid, pidfd) in the parent and
+        # (0, None) in the child; pidfd is None on kernels without CLONE_PIDFD.
+        # The raw syscall skips glibc's fork handling, so another thread holding
+        # a libc lock (malloc, stdio) would leave it locked forever in the
+        # child. Callers fork first if they may have started threads.
+        if threading.active_count() != 1:
+            raise RuntimeError(
+                "clone needs a single-threaded caller, "
+                f"{threading.active_count()} threads are running"
+            )
+        pidfd = ctypes.c_int(-1)
+        ctypes.pythonapi.PyOS_BeforeFork()
+        pid = self._raw_clone(flags | CLONE_PIDFD, pidfd)
+        if pid == -1 and ctypes.get_errno() == errno.EINVAL:
+            pid = self._raw_clone(flags, pidfd)
+        err = ctypes.get_errno()
+        if pid == 0:
+            ctypes.pythonapi.PyOS_AfterFork_Child()
+            return 0, None
+        ctypes.pythonapi.PyOS_AfterFork_Parent()
+        if pid == -1:
+            raise OSError(err, f"Failed to clone: {os.strerror(err)}")
+        return pid, (pidfd.value if pidfd.value >= 0 else None)
+
+    def spawn(self, flags, setup, *args):
+        # Runs setup(*args) as the pre-exec routine of a child created in the
+        # requested namespaces. setup is expected to exec; if it returns or
+        # raises, the child exits without unwinding into the caller.
+        pid, pidfd = self.clone(flags)
+        if pid == 0:
+            code = 1
+            try:
+                setup(*args)
+            except BaseException:
+                traceback.print_exc()
+            else:
+                code = 0
+            finally:
+                os._exit(code)
+        return pid, pidfd
+
     def setns(self, netns_name):
         netns_path = f"/var/run/netns/{netns_name}"
         with open(netns_path, "r") as f:
@@ -52,19 +226,67 @@ class FuncTools:
             raise OSError(errno, os.strerror(errno))
 
     def mount(self, source, target, fs_type, options=None):
-        cmd = ["mount"]
+        flags, data, loop = parse_mount_options(options)
+        loop_fd = None
+        if loop:
+            source, loop_fd = self.attach_loop(source, read_only=bool(flags & MS_RDONLY))
+        try:
+            self.mount2(source, target, fs_type, flags, data)
+        finally:
+            if loop_fd is not None:
+                # With LO_FLAGS_AUTOCLEAR the device now lives as long as the mount.
+                os.close(loop_fd)
 
-        if options:
-            cmd.extend(["-o", options])
-        if fs_type:
-            cmd.extend(["-t", fs_type])
-        cmd.extend([source, target])
+    def mount2(self, source, target, fs_type, flags=0, data=None):
+        ret = libc.mount(
+            _encode(source), _encode(target), _encode(fs_type), flags, _encode(data)
+        )
+        if ret != 0:
+            err = ctypes.get_errno()
+            raise OSError(
+                err, f"Failed to mount {source} on {target}: {os.strerror(err)}"
+            )
+
+    def make_rprivate(self, target="/"):
+        self.mount2(None, target, None, MS_REC | MS_PRIVATE)
 
+    def attach_loop(self, backing_file, read_only=True):
+        flags = LO_FLAGS_AUTOCLEAR | (LO_FLAGS_READ_ONLY if read_only else 0)
+        backing_fd = os.open(backing_file, os.O_RDONLY if read_only else os.O_RDWR)
         try:
-            subprocess.run(
-                cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to mount {source} to {target}: {e}", file=sys.stderr)
-            raise
-        pass
+            ctl_fd = os.open("/dev/loop-control", os.O_RDWR | os.O_CLOEXEC)
+            try:
+                for _ in range(16):
+                    number = fcntl.ioctl(ctl_fd, LOOP_CTL_GET_FREE)
+                    device = f"/dev/loop{number}"
+                    loop_fd = os.open(
+                        device, (os.O_RDONLY if read_only else os.O_RDWR) | os.O_CLOEXEC
+                    )
+                    try:
+                        self._configure_loop(loop_fd, backing_fd, backing_file, flags)
+                        return device, loop_fd
+                    except OSError as e:
+                        os.close(loop_fd)
+                        # Someone else grabbed the same free device; try again.
+                        if e.errno != errno.EBUSY:
+                            raise
+                        time.sleep(0.01)
+                raise OSError(errno.EBUSY, f"No free loop device for {backing_file}")
+            finally:
+                os.close(ctl_fd)
+        finally:
+            os.close(backing_fd)
+
+    def _configure_loop(self, loop_fd, backing_fd, backing_file, flags):
+        info = LOOP_INFO64.pack(
+            0, 0, 0, 0, 0, 0, 0, 0, flags, _encode(backing_file)[:63], b"", b"", 0, 0
+        )
+        try:
+            config = struct.pack("=II", backing_fd, 0) + info + bytes(64)
+            fcntl.ioctl(loop_fd, LOOP_CONFIGURE, config)
+        except OSError as e:
+            # LOOP_CONFIGURE is Linux 5.8+; older kernels need two ioctls.
+            if e.errno not in (errno.EINVAL, errno.ENOTTY):
+                raise
+            fcntl.ioctl(loop_fd, LOOP_SET_FD, backing_fd)
+            fcntl.ioctl(loop_fd, LOOP_SET_STATUS64, info)
@@ -0,0 +1,552 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from dedup import DedupStats, DedupStore
+from functions import FuncTools
+from unpack import unpack
+
+CACHE_DIRNAME = ".cache"
+DIGEST_ALGO = "sha256"
+READ_CHUNK = 1024 * 1024
+
+CACHE_BUDGET_ENV = "CONTAINERR_IMAGE_CACHE_BUDGET"
+# Entries used this recently are never evicted, which covers the window between
+# resolving an image and registering the container that uses it.
+EVICTION_GRACE = 60
+STATS_LOG_FLAGS = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+SIZE_SUFFIXES = {"k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+# Read-only filesystem images that can be loop-mounted as an overlay lowerdir,
+# in order of preference when several exist for the same image name.
+READONLY_FORMATS = ("erofs", "squashfs")
+READONLY_BUILDERS = {
+    "squashfs": lambda src, out: [
+        "mksquashfs",
+        src,
+        out,
+        "-comp",
+        "zstd",
+        "-noappend",
+        "-no-progress",
+    ],
+    "erofs": lambda src, out: ["mkfs.erofs", "-zlz4hc", out, src],
+}
+
+MANIFEST_SUFFIX = "json"
+
+tools = FuncTools()
+
+
+def load_manifest(manifest_path):
+    # {"layers": ["base.tar.gz", "tooling.tar.gz"]}, bottom layer first, paths
+    # relative to the manifest.
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    layers = manifest.get("layers") if isinstance(manifest, dict) else None
+    if not isinstance(layers, list) or not layers:
+        raise ValueError(f"{manifest_path}: 'layers' must be a non-empty list")
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    return [os.path.join(base, layer) for layer in layers]
+
+
+def list_images(image_dir, image_suffix):
+    images = {}
+    for entry in sorted(os.listdir(image_dir)):
+        path = os.path.join(image_dir, entry)
+        if entry.startswith(".") or not os.path.isfile(path):
+            continue
+        if entry.endswith(os.extsep + MANIFEST_SUFFIX):
+            name = entry[: -len(os.extsep + MANIFEST_SUFFIX)]
+            images[name] = load_manifest(path)
+            continue
+        for suffix in (image_suffix,) + READONLY_FORMATS:
+            if entry.endswith(os.extsep + suffix):
+                images.setdefault(entry[: -len(os.extsep + suffix)], [path])
+    return images
+
+
+@contextmanager
+def _locked(lock_path, blocking=True):
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def parse_size(value):
+    if value in (None, ""):
+        return None
+    value = str(value).strip().lower()
+    if value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def _disk_usage(path, seen=None):
+    # Pass one seen set across trees to count inodes they share only once.
+    seen = set() if seen is None else seen
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if st.st_nlink > 1 and not os.path.isdir(os.path.join(dirpath, name)):
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def _exclusive_usage(path, outside_links=0):
+    # Bytes deleting path frees: inodes with no links outside it beyond
+    # outside_links (the dedup store's own link to an object).
+    inodes = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            key = (st.st_dev, st.st_ino)
+            if key in inodes:
+                inodes[key][0] += 1
+            else:
+                inodes[key] = [1, st]
+    total = 0
+    for links, st in inodes.values():
+        if stat.S_ISDIR(st.st_mode) or st.st_nlink - links <= outside_links:
+            total += st.st_blocks * 512
+    return total
+
+
+def _process_start_time(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Field 22, counted after the parenthesised command name.
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def file_digest(path):
+    h = hashlib.new(DIGEST_ALGO)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def convert_image(image_path, out_path, fs_type):
+    if fs_type not in READONLY_BUILDERS:
+        raise ValueError(f"Unsupported image format {fs_type}")
+    cmd = READONLY_BUILDERS[fs_type]
+    if not shutil.which(cmd("", "")[0]):
+        raise RuntimeError(f"{cmd('', '')[0]} is required to build {fs_type} images")
+
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    tmp_root = tempfile.mkdtemp(prefix=".convert-", dir=out_dir)
+    tmp_out = f"{out_path}.tmp{os.getpid()}"
+    try:
+        rootfs = os.path.join(tmp_root, "rootfs")
+        unpack(image_path, rootfs)
+        subprocess.run(cmd(rootfs, tmp_out), check=True, stdout=subprocess.DEVNULL)
+        os.rename(tmp_out, out_path)
+    finally:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        if os.path.exists(tmp_out):
+            os.unlink(tmp_out)
+    print(f"Converted {image_path} to {fs_type} image {out_path}")
+    return out_path
+
+
+class ImageCache:
+    # Extracted rootfs trees live under <image_dir>/.cache/<algo>-<digest>/rootfs
+    # and are only ever published by renaming a fully extracted temp dir, so an
+    # entry that exists is always complete.
+
+    def __init__(self, image_dir, budget=None):
+        self.image_dir = image_dir
+        self.budget = parse_size(
+            budget if budget is not None else os.environ.get(CACHE_BUDGET_ENV)
+        )
+        self.cache_dir = os.path.join(image_dir, CACHE_DIRNAME)
+        self.index_dir = os.path.join(self.cache_dir, "index")
+        self.lock_dir = os.path.join(self.cache_dir, "locks")
+        self.mount_dir = os.path.join(self.cache_dir, "mnt")
+        self.store = DedupStore(os.path.join(self.cache_dir, "objects"))
+
+    def _ensure_dirs(self):
+        for d in (self.cache_dir, self.index_dir, self.lock_dir, self.mount_dir):
+            os.makedirs(d, exist_ok=True)
+
+    def entry_path(self, digest):
+        return os.path.join(self.cache_dir, f"{DIGEST_ALGO}-{digest}")
+
+    def _index_path(self, image_path):
+        return os.path.join(self.index_dir, f"{os.path.basename(image_path)}.json")
+
+    def _lock_path(self, key):
+        return os.path.join(self.lock_dir, f"{key}.lock")
+
+    def _stats_path(self):
+        return os.path.join(self.cache_dir, "stats.json")
+
+    def _stats_log_path(self):
+        return os.path.join(self.cache_dir, "stats.log")
+
+    def stats(self):
+        # Totals kept in stats.json by older versions, plus the counter log.
+        stats = {"hits": 0, "misses": 0, "evictions": 0}
+        try:
+            with open(self._stats_path()) as f:
+                stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(self._stats_log_path()) as f:
+                for line in f:
+                    counter, _, n = line.partition(" ")
+                    try:
+                        stats[counter] = stats.get(counter, 0) + int(n)
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+        return stats
+
+    def _bump(self, counter, n=1):
+        # On the startup path: one O_APPEND write, no lock and no fsync. A
+        # line this short is written in one piece, so concurrent starts don't
+        # interleave.
+        line = f"{counter} {n}\n".encode()
+        try:
+            if not os.path.isdir(self.cache_dir):
+                self._ensure_dirs()
+            fd = os.open(self._stats_log_path(), STATS_LOG_FLAGS, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"Error updating image cache stats: {e}")
+
+    def _touch(self, entry):
+        try:
+            os.utime(os.path.join(entry, "last_used"))
+        except FileNotFoundError:
+            open(os.path.join(entry, "last_used"), "w").close()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _stat_key(image_path):
+        st = os.stat(image_path)
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino}
+
+    def _cached_digest(self, image_path):
+        try:
+            with open(self._index_path(image_path)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get("path") != image_path:
+            return None
+        if record.get("stat") != self._stat_key(image_path):
+            return None
+        return record.get("digest")
+
+    def _digest(self, image_path):
+        # Caller holds the per-image lock.
+        digest = self._cached_digest(image_path)
+        if digest is None:
+            stat_key = self._stat_key(image_path)
+            digest = file_digest(image_path)
+            _write_json_atomic(
+                self._index_path(image_path),
+                {"path": image_path, "stat": stat_key, "digest": digest},
+            )
+        return digest
+
+    def digest(self, image_path):
+        digest = self._cached_digest(image_path)
+        if digest is not None:
+            return digest
+        self._ensure_dirs()
+        with _locked(self._lock_path(os.path.basename(image_path))):
+            return self._digest(image_path)
+
+    def is_cached(self, digest):
+        return os.path.isdir(
+            os.path.join(self.entry_path(digest), "rootfs")
+        ) or os.path.ismount(os.path.join(self.mount_dir, f"{DIGEST_ALGO}-{digest}"))
+
+    def layer_root(self, layer_path):
+        name = os.path.basename(layer_path)
+        for fs_type in READONLY_FORMATS:
+            if name.endswith(os.extsep + fs_type):
+                return self.mount(name, layer_path, fs_type)
+        return self.get(name, layer_path)
+
+    def lowerdir(self, layer_paths):
+        # overlayfs wants the topmost layer first.
+        return ":".join(self.layer_root(p) for p in reversed(layer_paths))
+
+    def entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        prefix = f"{DIGEST_ALGO}-"
+        return [
+            os.path.join(self.cache_dir, name)
+            for name in sorted(os.listdir(self.cache_dir))
+            if name.startswith(prefix)
+        ]
+
+    def dedup(self):
+        # Hardlinks identical files across every extracted image and layer. Once
+        # the object store exists, new extractions are deduplicated on publish.
+        stats = DedupStats()
+        os.makedirs(self.store.root, exist_ok=True)
+        for entry in self.entries():
+            rootfs = os.path.join(entry, "rootfs")
+            with _locked(self._lock_path(os.path.basename(entry))):
+                self.store.dedup_tree(rootfs, stats)
+        self.store.prune()
+        return stats
+
+    def lookup(self, image_path):
+        digest = self._cached_digest(image_path)
+        if digest is None:
+            return None
+        rootfs = os.path.join(self.entry_path(digest), "rootfs")
+        if os.path.isdir(rootfs):
+            self._touch(self.entry_path(digest))
+            return rootfs
+        return None
+
+    def get(self, image_name, image_path):
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"Unable to locate image {image_name}")
+
+        rootfs = self.lookup(image_path)
+        if rootfs:
+            self._bump("hits")
+            return rootfs
+
+        self._ensure_dirs()
+        with _locked(self._lock_path(os.path.basename(image_path))):
+            rootfs = self.lookup(image_path)
+            if rootfs:
+                self._bump("hits")
+                return rootfs
+
+            return self._populate(self._digest(image_path), image_path)
+
+    def mount(self, image_name, image_path, fs_type):
+        # Loop-mounts a read-only filesystem image once per host; every container
+        # of that image then shares the mount (and its page cache) as lowerdir.
+        # Must run in the host mount namespace, before the container unshares.
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"Unable to locate image {image_name}")
+
+        digest = self._cached_digest(image_path)
+        if digest is not None:
+            mountpoint = os.path.join(self.mount_dir, f"{DIGEST_ALGO}-{digest}")
+            if os.path.ismount(mountpoint):
+                self._bump("hits")
+                return mountpoint
+
+        self._ensure_dirs()
+        with _locked(self._lock_path(os.path.basename(image_path))):
+            digest = self._digest(image_path)
+            mountpoint = os.path.join(self.mount_dir, f"{DIGEST_ALGO}-{digest}")
+            if not os.path.ismount(mountpoint):
+                os.makedirs(mountpoint, exist_ok=True)
+                tools.mount(image_path, mountpoint, fs_type, "loop,ro")
+                print(f"Mounted {image_path} at {mountpoint}")
+                self._bump("misses")
+            else:
+                self._bump("hits")
+            return mountpoint
+
+    def _populate(self, digest, image_path):
+        entry = self.entry_path(digest)
+        rootfs = os.path.join(entry, "rootfs")
+
+        with _locked(self._lock_path(f"{DIGEST_ALGO}-{digest}")):
+            if os.path.isdir(rootfs):
+                self._touch(entry)
+                self._bump("hits")
+                return rootfs
+
+            # Anything left over from an interrupted extraction of this digest is
+            # garbage: we hold the lock, so nobody else can be writing to it.
+            prefix = f".tmp-{digest}-"
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(prefix):
+                    shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+            tmp_entry = tempfile.mkdtemp(prefix=prefix, dir=self.cache_dir)
+            try:
+                tmp_rootfs = os.path.join(tmp_entry, "rootfs")
+                os.makedirs(tmp_rootfs)
+                print(f"Extracting {image_path} into image cache")
+                unpack(image_path, tmp_rootfs)
+                if self.store.exists():
+                    self.store.dedup_tree(tmp_rootfs)
+                _write_json_atomic(
+                    os.path.join(tmp_entry, "meta.json"),
+                    {"source": image_path, "size": _disk_usage(tmp_rootfs)},
+                )
+                open(os.path.join(tmp_entry, "last_used"), "w").close()
+                os.chmod(tmp_entry, 0o755)
+                os.rename(tmp_entry, entry)
+            except BaseException:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                raise
+            self._bump("misses")
+
+        return rootfs
+
+    def _entries_for(self, lowerdir):
+        entries = []
+        for path in lowerdir.split(":"):
+            entry = os.path.dirname(path)
+            if os.path.dirname(entry) == self.cache_dir and os.path.basename(
+                entry
+            ).startswith(f"{DIGEST_ALGO}-"):
+                entries.append(entry)
+        return entries
+
+    def add_ref(self, lowerdir, container_id, pid):
+        # Marks the cached trees behind a container's lowerdir as in use for as
+        # long as the process with this pid (and start time) is alive.
+        for entry in self._entries_for(lowerdir):
+            refs = os.path.join(entry, "refs")
+            os.makedirs(refs, exist_ok=True)
+            with open(os.path.join(refs, container_id), "w") as f:
+                f.write(f"{pid} {_process_start_time(pid)}")
+
+    def drop_ref(self, lowerdir, container_id):
+        for entry in self._entries_for(lowerdir):
+            try:
+                os.unlink(os.path.join(entry, "refs", container_id))
+            except FileNotFoundError:
+                pass
+
+    def _live_refs(self, entry):
+        refs = os.path.join(entry, "refs")
+        live = 0
+        try:
+            names = os.listdir(refs)
+        except FileNotFoundError:
+            return live
+        for name in names:
+            path = os.path.join(refs, name)
+            try:
+                with open(path) as f:
+                    pid, start = f.read().split()
+            except (OSError, ValueError):
+                continue
+            if _process_start_time(pid) == start:
+                live += 1
+            else:
+                os.unlink(path)
+        return live
+
+    def _freed_by(self, entry):
+        # Files hardlinked into the dedup store carry one link from the store,
+        # which prune() drops once the entry is gone; links from other entries
+        # keep the bytes in use.
+        outside_links = 1 if self.store.exists() else 0
+        return _exclusive_usage(os.path.join(entry, "rootfs"), outside_links)
+
+    def _last_used(self, entry):
+        try:
+            return os.stat(os.path.join(entry, "last_used")).st_mtime
+        except FileNotFoundError:
+            return os.stat(entry).st_mtime
+
+    def usage(self):
+        # Bytes on disk, counting files that entries share through the dedup
+        # store once.
+        seen = set()
+        return sum(
+            _disk_usage(os.path.join(entry, "rootfs"), seen) for entry in self.entries()
+        )
+
+    def evict(self, budget=None):
+        budget = self.budget if budget is None else parse_size(budget)
+        if budget is None or not os.path.isdir(self.cache_dir):
+            return 0
+
+        self._ensure_dirs()
+        with _locked(self._lock_path("evict"), blocking=False) as acquired:
+            if not acquired:
+                return 0
+
+            entries = [(self._last_used(entry), entry) for entry in self.entries()]
+            total = self.usage()
+            now = time.time()
+            evicted = 0
+            for last_used, entry in sorted(entries):
+                if total <= budget:
+                    break
+                if now - last_used < EVICTION_GRACE or self._live_refs(entry):
+                    continue
+                size = self._freed_by(entry)
+                key = os.path.basename(entry)
+                with _locked(self._lock_path(key), blocking=False) as acquired:
+                    if not acquired:
+                        continue
+                    # Unpublish atomically first; lookups then miss and
+                    # re-extract instead of seeing a half-deleted tree.
+                    doomed = os.path.join(self.cache_dir, f".evict-{key}")
+                    shutil.rmtree(doomed, ignore_errors=True)
+                    os.rename(entry, doomed)
+                shutil.rmtree(doomed, ignore_errors=True)
+                total -= size
+                evicted += 1
+                print(f"Evicted {key} from image cache ({size} bytes)")
+
+            if evicted:
+                self.store.prune()
+                self._bump("evictions", evicted)
+            return evicted
+
+    def evict_in_background(self):
+        # Double fork so eviction never blocks the caller and leaves no zombie.
+        if self.budget is None:
+            return
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if os.fork() == 0:
+                    try:
+                        self.evict()
+                    except Exception as e:
+                        print(f"Error evicting image cache entries: {e}")
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
@@ -1,27 +1,31 @@
+import functools
 import os
 import re
 from networking import (
     configure_iptables,
-    container_network,
     create_bridge,
-    create_namespace,
-    create_veth_pair,
     enable_ip_forward,
     generate_gateway_ip,
-    generate_random_ip,
-    generate_random_name,
     get_active_interface,
     get_bridge_ip,
-    move_veth,
 )
 import random
 import stat
-import subprocess
-import tarfile
 import uuid
 import sys
 import click
-from functions import FuncTools
+from functions import FuncTools, overlay_options
+from images import (
+    MANIFEST_SUFFIX,
+    READONLY_BUILDERS,
+    READONLY_FORMATS,
+    ImageCache,
+    convert_image,
+    list_images,
+    load_manifest,
+)
+from netpool import NETNS_DIR, NetPool
+import tracing
 from constants import CLONE_NEWNS, CLONE_NEWPID, CLONE_NEWUTS, CLONE_NEWNET
 
 tools = FuncTools()
@@ -29,15 +33,23 @@ tools = FuncTools()
 subnet = "192.168.3.0/24"
 
 bridge_name = "custom_bridge"
-veth_host = generate_random_name("eth")
-container_ip = generate_random_ip(subnet)
-gateway_ip = generate_gateway_ip(subnet)
-bridge_ip = get_bridge_ip(bridge_name)
-if not bridge_ip:
-    bridge_ip = generate_random_ip(subnet)
 
 
-interface = get_active_interface()
+# Both need netlink round-trips (and the interface a default route), so they are
+# resolved on first use rather than on every import.
+@functools.cache
+def get_bridge_address():
+    bridge_ip = get_bridge_ip(bridge_name)
+    if not bridge_ip:
+        bridge_ip = f"{generate_gateway_ip(subnet)}/{subnet.split('/')[1]}"
+    return bridge_ip
+
+
+@functools.cache
+def get_interface():
+    return get_active_interface()
+
+
 dir = os.getcwd()
 
 
@@ -69,6 +81,18 @@ def _get_image_path(image_name, image_dir, image_suffix="tar.gz"):
     return os.path.join(image_dir, os.extsep.join([image_name, image_suffix]))
 
 
+def _get_image_root(image_name, image_dir):
+    cache = ImageCache(image_dir)
+    manifest = _get_image_path(image_name, image_dir, MANIFEST_SUFFIX)
+    if os.path.exists(manifest):
+        return cache.lowerdir(load_manifest(manifest))
+    for fs_type in READONLY_FORMATS:
+        fs_image = _get_image_path(image_name, image_dir, fs_type)
+        if os.path.exists(fs_image):
+            return cache.mount(image_name, fs_image, fs_type)
+    return cache.get(image_name, _get_image_path(image_name, image_dir))
+
+
 def _get_container_path(container_id, container_dir, *subdir_names):
     return os.path.join(container_dir, container_id, *subdir_names)
 
@@ -131,26 +155,9 @@ def _setup_memory_cgroup(container_id, memory, memory_swap):
             f.write(str(memory_swap))
 
 
-def create_container_root(
-    image_name, image_dir, container_id, container_name, container_dir
-):
-    image_path = _get_image_path(image_name, image_dir)
-    print(image_path)
-    image_root = os.path.join(image_dir, image_name, "rootfs")
-
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"Unable to locate image {image_name}")
-
-    if not os.path.exists(image_root):
-        os.makedirs(image_root)
-        with tarfile.open(image_path) as t:
-            members = [
-                m
-                for m in t.getmembers()
-                if m.type not in (tarfile.CHRTYPE, tarfile.BLKTYPE)
-            ]
-            t.extractall(image_root, members=members)
-
+@tracing.traced("rootfs.overlay")
+def create_container_root(image_root, container_id, container_name, container_dir):
+    # image_root is the lowerdir run() resolved in the host mount namespace.
     container_cow_rw = _get_container_path(
         f"{container_name}_{container_id}", container_dir, "cow_rs"
     )
@@ -164,15 +171,19 @@ def create_container_root(
         if not os.path.exists(d):
             os.makedirs(d)
 
+    with open(
+        _get_container_path(
+            f"{container_name}_{container_id}", container_dir, "lowerdir"
+        ),
+        "w",
+    ) as f:
+        f.write(image_root)
+
     tools.mount(
         "overlay",
         container_rootfs,
         "overlay",
-        "lowerdir={image_root},upperdir={cow_rw},workdir={cow_workdir}".format(
-            image_root=image_root,
-            cow_rw=container_cow_rw,
-            cow_workdir=container_cow_workdir,
-        ),
+        overlay_options(image_root, container_cow_rw, container_cow_workdir),
     )
     print(container_rootfs)
     return container_rootfs
@@ -193,6 +204,7 @@ def _unmount(new_root):
         print(e)
 
 
+@tracing.traced("rootfs.mounts")
 def _create_mount(new_root):
     proc_path = os.path.join(new_root, "proc")
     sys_path = os.path.join(new_root, "sys")
@@ -223,22 +235,40 @@ def _create_mount(new_root):
         raise
 
 
-def mount_fs(container_name, command):
+def _record_netns(container_dir, container_name, netns_namespace):
+    container_path = _get_container_path(container_name, container_dir)
+    os.makedirs(container_path, exist_ok=True)
+    with open(os.path.join(container_path, "netns"), "w") as f:
+        f.write(netns_namespace)
+
+
+def _find_container(container_name):
     rootdir = f"{os.getcwd()}/containers"
-    container_final = None
     pattern = re.compile(rf"^{re.escape(container_name)}_[a-f0-9-]+$")
     for entry in os.listdir(rootdir):
         if pattern.match(entry):
-            container_final = os.path.join(rootdir, entry)
-            break
-    if not container_final:
-        raise RuntimeError(f"No matching container found for {container_name}")
+            return os.path.join(rootdir, entry)
+    raise RuntimeError(f"No matching container found for {container_name}")
 
-    container_id = container_final.split("_")
 
-    netns_namespace = f"netns_{container_id[-1]}"
+def _container_netns(container_final):
+    container_id = container_final.split("_")[-1]
+    netns_file = os.path.join(container_final, "netns")
+    if os.path.exists(netns_file):
+        with open(netns_file) as f:
+            return container_id, f.read().strip()
+    return container_id, f"netns_{container_id}"
 
-    lowerdir = f"{os.getcwd()}/images/ubuntu/rootfs"
+
+def mount_fs(container_name, netns_namespace, command):
+    container_final = _find_container(container_name)
+
+    lowerdir_file = os.path.join(container_final, "lowerdir")
+    if os.path.exists(lowerdir_file):
+        with open(lowerdir_file) as f:
+            lowerdir = f.read().strip()
+    else:
+        lowerdir = f"{os.getcwd()}/images/ubuntu/rootfs"
     upperdir = os.path.join(container_final, "cow_rs")
     workdir = os.path.join(container_final, "cow_workdir")
     target = os.path.join(container_final, "rootfs")
@@ -248,7 +278,7 @@ def mount_fs(container_name, command):
     os.makedirs(target, exist_ok=True)
 
     if not os.path.ismount(target):
-        options = f"lowerdir={lowerdir},upperdir={upperdir},workdir={workdir}"
+        options = overlay_options(lowerdir, upperdir, workdir)
         tools.mount("overlay", target, "overlay", options)
 
     else:
@@ -256,7 +286,7 @@ def mount_fs(container_name, command):
 
     tools.setns(netns_namespace)
     tools.sethostname(container_name)
-    subprocess.run(["mount", "--make-rprivate", "/"], check=True)
+    tools.make_rprivate("/")
     new_root = target
     old_root = os.path.join(new_root, "old_root")
     os.makedirs(old_root, exist_ok=True)
@@ -275,8 +305,7 @@ def mount_fs(container_name, command):
 
 def contain(
     command,
-    image_name,
-    image_dir,
+    image_root,
     container_id,
     container_dir,
     cpu_shares,
@@ -288,26 +317,31 @@ def contain(
     container_exist=False,
 ):
     if not container_exist:
-        tools.setns(netns_namespace)
-        _setup_cpu_cgroup(container_id, cpu_shares)
-        _setup_memory_cgroup(container_id, memory, memory_swap)
+        tracing.start_child()
+        with tracing.span("netns.join"):
+            tools.setns(netns_namespace)
+        with tracing.span("cgroup.setup"):
+            _setup_cpu_cgroup(container_id, cpu_shares)
+            _setup_memory_cgroup(container_id, memory, memory_swap)
         tools.sethostname(container_name)
-        subprocess.run(["mount", "--make-rprivate", "/"], check=True)
+        with tracing.span("mount.make_rprivate"):
+            tools.make_rprivate("/")
 
         new_root = create_container_root(
-            image_name, image_dir, container_id, container_name, container_dir
+            image_root, container_id, container_name, container_dir
         )
 
         _create_mount(new_root)
-        old_root = os.path.join(new_root, "old_root")
-        os.makedirs(old_root)
+        with tracing.span("rootfs.pivot_root"):
+            old_root = os.path.join(new_root, "old_root")
+            os.makedirs(old_root)
 
-        tools.pivot_root(new_root, old_root)
+            tools.pivot_root(new_root, old_root)
 
-        os.chdir("/")
+            os.chdir("/")
 
-        tools.umount("/old_root", 2)
-        os.rmdir("/old_root")
+            tools.umount("/old_root", 2)
+            os.rmdir("/old_root")
 
         with open("/etc/resolv.conf", "w") as f:
             f.write("nameserver 8.8.8.8")
@@ -323,6 +357,7 @@ def contain(
             os.setgid(gid)
             os.setuid(uid)
 
+        tracing.flush_child()
         os.execvp(command[0], command)
 
 
@@ -361,6 +396,13 @@ def contain(
     help="Containers directory",
     default=os.path.join(dir, "containers/"),
 )
+@click.option(
+    "--trace",
+    "trace_file",
+    default=None,
+    help="Write a Chrome trace of the startup phases to this file"
+    " (or a new file per run in this directory)",
+)
 @click.argument("command", required=True, nargs=-1)
 def run(
     name,
@@ -371,49 +413,65 @@ def run(
     image_name,
     image_dir,
     container_dir,
+    trace_file,
     command,
 ):
+    if trace_file:
+        tracing.enable(trace_file)
+    startup = tracing.begin("run.startup", name=name, image=image_name)
     container_id = str(uuid.uuid4())
 
     print(name)
-    veth_container = f"veth{container_id[0:5]}"
-    create_bridge(bridge_name, bridge_ip)
-    create_veth_pair(veth_host, veth_container, bridge_name)
-    enable_ip_forward()
-    configure_iptables(bridge_name, interface, subnet)
+    with tracing.span("network.setup"):
+        create_bridge(bridge_name, get_bridge_address())
+        enable_ip_forward()
+        configure_iptables(bridge_name, get_interface(), subnet)
+
+        net_pool = NetPool(bridge_name, get_bridge_address(), subnet)
+        with tracing.span("netns.claim"):
+            net = net_pool.claim(os.getpid(), container_id)
+        netns_namespace = net["netns"]
+        _record_netns(container_dir, f"{name}_{container_id}", netns_namespace)
+
+    # Resolve (and for read-only images, mount) the image in the host mount
+    # namespace so the result is shared with every other container.
+    with tracing.span("image.resolve"):
+        image_root = _get_image_root(image_name, image_dir)
+    image_cache = ImageCache(image_dir)
 
-    netns_namespace = f"netns_{container_id}"
-    create_namespace(netns_namespace)
-
-    move_veth(netns_namespace, veth_container)
-
-    container_network(netns_namespace, container_ip, veth_container, bridge_ip)
     flags = CLONE_NEWPID | CLONE_NEWNS | CLONE_NEWUTS
-    tools.unshare(flags)
-
-    pid = os.fork()
-    if pid > 0:
-        print(pid)
-    if pid == 0:
-        contain(
-            command,
-            image_name,
-            image_dir,
-            container_id,
-            container_dir,
-            cpu_share,
-            memory,
-            memory_swap,
-            user,
-            name,
-            netns_namespace,
-        )
-
-        os._exit(0)
+    tracing.prepare_child()
+    pid, pidfd = tools.spawn(
+        flags,
+        contain,
+        command,
+        image_root,
+        container_id,
+        container_dir,
+        cpu_share,
+        memory,
+        memory_swap,
+        user,
+        name,
+        netns_namespace,
+    )
+    print(f"Spawned container process {pid} (pidfd {pidfd})")
+    startup.end()
+    net_pool.attach(net, pid)
+    image_cache.add_ref(image_root, container_id, pid)
+    image_cache.evict_in_background()
+    net_pool.fill_in_background()
 
     _, status = os.waitpid(pid, 0)
+    if pidfd is not None:
+        os.close(pidfd)
+    image_cache.drop_ref(image_root, container_id)
+    net_pool.release(net)
     exit_code = os.WEXITSTATUS(status)
     print(f"Child process {pid} exited with status {exit_code}")
+    trace_path = tracing.write(pid)
+    if trace_path:
+        print(f"Wrote startup trace to {trace_path}")
 
 
 # mounting
@@ -425,20 +483,141 @@ def run(
 @click.option("--container-name", "-n", required=True, help="Container name")
 @click.argument("command", required=True, nargs=-1)
 def mount(container_name, command):
-    flags = CLONE_NEWPID | CLONE_NEWNS | CLONE_NEWUTS
-    tools.unshare(flags)
+    container_id, netns_namespace = _container_netns(_find_container(container_name))
+
+    # A pooled namespace is destroyed when its container exits, so only join it
+    # while that container still holds it; otherwise take a fresh one.
+    net_pool = NetPool(bridge_name, get_bridge_address(), subnet)
+    net = None
+    if not net_pool.held_by(netns_namespace, container_id) and (
+        net_pool.is_pooled(netns_namespace)
+        or not os.path.exists(os.path.join(NETNS_DIR, netns_namespace))
+    ):
+        net = net_pool.claim(os.getpid(), container_id)
+        netns_namespace = net["netns"]
 
-    pid = os.fork()
-    if pid > 0:
-        print(pid)
-    if pid == 0:
-        mount_fs(container_name, command)
-        os._exit(0)
+    flags = CLONE_NEWPID | CLONE_NEWNS | CLONE_NEWUTS
+    pid, pidfd = tools.spawn(flags, mount_fs, container_name, netns_namespace, command)
+    print(f"Spawned container process {pid} (pidfd {pidfd})")
+    if net is not None:
+        net_pool.attach(net, pid)
 
     _, status = os.waitpid(pid, 0)
+    if pidfd is not None:
+        os.close(pidfd)
+    if net is not None:
+        net_pool.release(net)
     exit_code = os.WEXITSTATUS(status)
     print(f"Child process {pid} exited with status {exit_code}")
 
 
+# converting
+@cli.command()
+@click.option("--image-name", "-i", help="Image name", default="ubuntu")
+@click.option(
+    "--image-dir", help="Images directory", default=os.path.join(dir, "images/")
+)
+@click.option(
+    "--format",
+    "fs_type",
+    type=click.Choice(sorted(READONLY_BUILDERS)),
+    default="squashfs",
+    help="Read-only filesystem to build",
+)
+def convert(image_name, image_dir, fs_type):
+    image_path = _get_image_path(image_name, image_dir)
+    if not os.path.exists(image_path):
+        raise click.ClickException(f"Unable to locate image {image_name}")
+    convert_image(image_path, _get_image_path(image_name, image_dir, fs_type), fs_type)
+
+
+# listing
+@cli.command()
+@click.option(
+    "--image-dir", help="Images directory", default=os.path.join(dir, "images/")
+)
+def images(image_dir):
+    cache = ImageCache(image_dir)
+    found = list_images(image_dir, "tar.gz")
+    digests = {
+        name: [cache.digest(layer) for layer in layers]
+        for name, layers in found.items()
+    }
+    refs = {}
+    for layer_digests in digests.values():
+        for digest in set(layer_digests):
+            refs[digest] = refs.get(digest, 0) + 1
+
+    for name, layers in found.items():
+        print(f"{name} ({len(layers)} layer{'s' if len(layers) != 1 else ''})")
+        for layer, digest in zip(layers, digests[name]):
+            state = "cached" if cache.is_cached(digest) else "not cached"
+            print(
+                f"  {digest[:12]}  {os.path.basename(layer)}"
+                f"  refs={refs[digest]}  {state}"
+            )
+
+
+# deduplicating
+@cli.command()
+@click.option(
+    "--image-dir", help="Images directory", default=os.path.join(dir, "images/")
+)
+def dedup(image_dir):
+    cache = ImageCache(image_dir)
+    stats = cache.dedup()
+    print(stats)
+    print(f"{cache.store.shared_bytes()} bytes shared through hardlinks in total")
+
+
+# image cache maintenance
+@cli.command()
+@click.option(
+    "--image-dir", help="Images directory", default=os.path.join(dir, "images/")
+)
+@click.option(
+    "--budget",
+    help="Disk budget for extracted images (k, m, g suffixes). "
+    "Defaults to $CONTAINERR_IMAGE_CACHE_BUDGET",
+    default=None,
+)
+@click.option("--evict", is_flag=True, help="Evict down to the budget now")
+def cache(image_dir, budget, evict):
+    image_cache = ImageCache(image_dir, budget)
+    if evict:
+        image_cache.evict()
+    stats = image_cache.stats()
+    print(
+        f"hits={stats['hits']} misses={stats['misses']} evictions={stats['evictions']}"
+    )
+    budget = image_cache.budget if image_cache.budget is not None else "unlimited"
+    print(f"usage={image_cache.usage()} budget={budget}")
+
+
+@cli.command()
+@click.option(
+    "--size",
+    type=int,
+    default=None,
+    help="Namespaces to keep ready (default: $CONTAINERR_NETPOOL_SIZE)",
+)
+@click.option("--fill", is_flag=True, help="Create namespaces up to the pool size now")
+def netpool(size, fill):
+    net_pool = NetPool(bridge_name, get_bridge_address(), subnet, size=size)
+    if fill:
+        create_bridge(bridge_name, get_bridge_address())
+        print(f"Created {net_pool.fill()} network namespaces")
+    stats = net_pool.stats()
+    print(f"ready={stats['ready']} claimed={stats['claimed']} size={stats['size']}")
+
+
+@cli.command("trace-summary")
+@click.argument("trace_files", required=True, nargs=-1)
+def trace_summary(trace_files):
+    print(f"{'phase':<24} {'count':>6} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, count, p50, p99 in tracing.summarize(trace_files):
+        print(f"{name:<24} {count:>6} {p50:>10.2f} {p99:>10.2f}")
+
+
 if __name__ == "__main__":
     cli()
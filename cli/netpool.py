@@ -0,0 +1,259 @@
+import fcntl
+import json
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+
+from networking import (
+    container_network,
+    create_namespace,
+    create_veth_pair,
+    delete_namespace,
+)
+from ipam import IPAM
+
+NETPOOL_DIR = "/var/run/containerr/netpool"
+NETNS_DIR = "/var/run/netns"
+NETPOOL_SIZE_ENV = "CONTAINERR_NETPOOL_SIZE"
+DEFAULT_POOL_SIZE = 4
+# A claim is written in two steps (rename, then owner); give a claimer this long
+# before an ownerless claim is considered abandoned.
+CLAIM_GRACE = 60
+
+
+def pool_size():
+    value = os.environ.get(NETPOOL_SIZE_ENV)
+    if value in (None, ""):
+        return DEFAULT_POOL_SIZE
+    return int(value)
+
+
+@contextmanager
+def _locked(lock_path):
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _process_start_time(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def _read_record(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_record(path, record):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(record, f)
+    os.rename(tmp_path, path)
+
+
+class NetPool:
+    # Network namespaces that already have a veth pair on the bridge, loopback
+    # up, an address and a default route. Each one is a record file that moves
+    # from ready/ to claimed/ by rename, so concurrent claimers never share one,
+    # and is destroyed when released.
+
+    def __init__(self, bridge_name, bridge_ip, subnet, root=NETPOOL_DIR, size=None):
+        self.bridge_name = bridge_name
+        self.gateway = bridge_ip.split("/")[0]
+        self.subnet = subnet
+        self.root = os.path.join(root, bridge_name)
+        self.ready_dir = os.path.join(self.root, "ready")
+        self.claimed_dir = os.path.join(self.root, "claimed")
+        self.size = pool_size() if size is None else size
+        self.ipam = IPAM(subnet, reserved=[self.gateway])
+
+    def _ensure_dirs(self):
+        os.makedirs(self.ready_dir, exist_ok=True)
+        os.makedirs(self.claimed_dir, exist_ok=True)
+
+    def _names(self, directory):
+        try:
+            return [n for n in os.listdir(directory) if ".tmp" not in n]
+        except FileNotFoundError:
+            return []
+
+    def create(self):
+        token = uuid.uuid4().hex[:8]
+        record = {
+            "netns": f"cnet_{token}",
+            "veth_host": f"vh{token}",
+            "veth_container": f"vc{token}",
+            "gateway": self.gateway,
+        }
+        create_namespace(record["netns"])
+        try:
+            record["ip"] = self.ipam.allocate(record["netns"])
+        except BaseException:
+            self._destroy(record)
+            raise
+        create_veth_pair(
+            record["veth_host"],
+            record["veth_container"],
+            self.bridge_name,
+            record["netns"],
+        )
+        if not container_network(
+            record["netns"], record["ip"], record["veth_container"], self.gateway
+        ):
+            self._destroy(record)
+            raise RuntimeError(f"Could not set up network namespace {record['netns']}")
+        return record
+
+    def _destroy(self, record, path=None):
+        delete_namespace(record["netns"])
+        if "ip" in record:
+            self.ipam.free(record["ip"])
+        if path is not None:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _usable(self, record):
+        return record.get("gateway") == self.gateway and os.path.exists(
+            os.path.join(NETNS_DIR, record["netns"])
+        )
+
+    def claim(self, owner_pid, container_id):
+        self._ensure_dirs()
+        owner = {
+            "owner": f"{owner_pid} {_process_start_time(owner_pid)}",
+            "container_id": container_id,
+        }
+        names = self._names(self.ready_dir)
+        random.shuffle(names)
+        for name in names:
+            path = os.path.join(self.claimed_dir, name)
+            try:
+                os.rename(os.path.join(self.ready_dir, name), path)
+            except FileNotFoundError:
+                continue
+            try:
+                record = _read_record(path)
+            except (OSError, ValueError):
+                os.unlink(path)
+                continue
+            if not self._usable(record):
+                self._destroy(record, path)
+                continue
+            record.update(owner)
+            _write_record(path, record)
+            return record
+
+        # Pool is empty: build one on the critical path, as before.
+        record = self.create()
+        record.update(owner)
+        _write_record(os.path.join(self.claimed_dir, record["netns"]), record)
+        return record
+
+    def attach(self, record, pid):
+        # The container outlives its launcher if only the launcher is killed, so
+        # the claim stays live while either process is.
+        record["pids"] = [record["owner"], f"{pid} {_process_start_time(pid)}"]
+        _write_record(os.path.join(self.claimed_dir, record["netns"]), record)
+
+    def held_by(self, netns_name, container_id):
+        try:
+            record = _read_record(os.path.join(self.claimed_dir, netns_name))
+        except (OSError, ValueError):
+            return False
+        return record.get("container_id") == container_id and self._owner_alive(record)
+
+    def is_pooled(self, netns_name):
+        return any(
+            os.path.exists(os.path.join(d, netns_name))
+            for d in (self.ready_dir, self.claimed_dir)
+        )
+
+    def release(self, record):
+        # A container runs as root in its namespace and can leave netfilter
+        # rules, policy routes, neighbour entries and net.* sysctls behind, so a
+        # used namespace is never handed to another container; fill() replaces
+        # it with a fresh one off the critical path.
+        self._destroy(record, os.path.join(self.claimed_dir, record["netns"]))
+
+    def _owner_alive(self, record):
+        for owner in record.get("pids") or [record.get("owner")]:
+            if not owner:
+                return True
+            pid, start = owner.split()
+            if _process_start_time(pid) == start:
+                return True
+        return False
+
+    def reclaim(self):
+        # Containers killed outright never release their namespace; take back
+        # claims whose owner is gone.
+        reclaimed = 0
+        for name in self._names(self.claimed_dir):
+            path = os.path.join(self.claimed_dir, name)
+            try:
+                record = _read_record(path)
+                mtime = os.path.getmtime(path)
+            except (OSError, ValueError):
+                continue
+            if "owner" not in record and time.time() - mtime < CLAIM_GRACE:
+                continue
+            if "owner" in record and self._owner_alive(record):
+                continue
+            self.release(record)
+            reclaimed += 1
+        return reclaimed
+
+    def fill(self):
+        self._ensure_dirs()
+        with _locked(os.path.join(self.root, "fill.lock")) as acquired:
+            if not acquired:
+                return 0
+            self.reclaim()
+            self.ipam.reclaim()
+            created = 0
+            while len(self._names(self.ready_dir)) < self.size:
+                record = self.create()
+                _write_record(os.path.join(self.ready_dir, record["netns"]), record)
+                created += 1
+            return created
+
+    def fill_in_background(self):
+        # Double fork so refilling never blocks the caller and leaves no zombie.
+        if self.size <= 0:
+            return
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if os.fork() == 0:
+                    try:
+                        self.fill()
+                    except Exception as e:
+                        print(f"Error refilling network namespace pool: {e}")
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+    def stats(self):
+        return {
+            "ready": len(self._names(self.ready_dir)),
+            "claimed": len(self._names(self.claimed_dir)),
+            "size": self.size,
+        }
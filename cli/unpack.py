@@ -0,0 +1,279 @@
+import errno
+import os
+import stat
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Writer threads only pay off with spare CPUs and enough files to keep them
+# busy; below either threshold files are written on the reading thread.
+PARALLEL_MIN_CPUS = 4
+PARALLEL_MIN_FILES = 1024
+CPUS = os.cpu_count() or 1
+DEFAULT_WORKERS = min(8, CPUS * 2) if CPUS >= PARALLEL_MIN_CPUS else 0
+DEFAULT_MAX_PENDING_BYTES = 64 * 1024 * 1024
+READ_CHUNK = 1024 * 1024
+# Rough per-entry bookkeeping cost so that a flood of empty files is bounded too.
+ENTRY_OVERHEAD = 512
+# Small files are handed to the pool in batches; one task per file costs more in
+# executor bookkeeping and GIL hand-offs than the write itself.
+BATCH_FILES = 128
+BATCH_BYTES = 1024 * 1024
+# OCI layer whiteouts, translated to what overlayfs expects in a lowerdir.
+WHITEOUT_PREFIX = ".wh."
+WHITEOUT_OPAQUE = ".wh..wh..opq"
+# O_NOFOLLOW so a symlink planted earlier in the archive can't redirect a write.
+OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+class _ByteBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        with self.cond:
+            while self.used and self.used + n > self.limit:
+                self.cond.wait()
+            self.used += n
+
+    def release(self, n):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+
+def _safe_path(dest, name):
+    parts = [p for p in name.split("/") if p not in ("", ".")]
+    if not parts:
+        return None
+    if ".." in parts:
+        raise tarfile.TarError(f"Refusing to extract {name!r} outside of {dest}")
+    return os.path.join(dest, *parts)
+
+
+def _apply_owner(path, member, fd=None, follow=True):
+    try:
+        if fd is not None:
+            os.fchown(fd, member.uid, member.gid)
+        else:
+            os.chown(path, member.uid, member.gid, follow_symlinks=follow)
+    except OSError:
+        pass
+
+
+class _Unpacker:
+    def __init__(self, dest, workers, max_pending_bytes):
+        self.dest = dest
+        self.budget = _ByteBudget(max_pending_bytes)
+        self.workers = workers
+        self.pool = None
+        self.files = 0
+        self.chown = os.geteuid() == 0
+        self.known_dirs = {dest}
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.error = None
+        self.dirs = []
+        # Keyed by path so that a later archive entry for the same path replaces
+        # a link that has not been created yet.
+        self.symlinks = {}
+        self.hardlinks = {}
+        self.sync_threshold = max_pending_bytes // 4
+        self.batch = []
+        self.batch_paths = set()
+        self.batch_cost = 0
+
+    def _makedirs(self, path):
+        if path in self.known_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        self.known_dirs.add(path)
+
+    def _replace(self, create, path, *args):
+        # Optimistically create the entry; only a path that already exists pays
+        # for the extra unlink (a fresh extraction never does).
+        try:
+            return create(*args)
+        except (FileExistsError, OSError) as e:
+            if not isinstance(e, FileExistsError) and e.errno != errno.ELOOP:
+                raise
+        os.unlink(path)
+        return create(*args)
+
+    def _open(self, path):
+        return self._replace(os.open, path, path, OPEN_FLAGS, 0o600)
+
+    def _write_file(self, path, member, data):
+        fd = self._open(path)
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+            self._finish_file(fd, path, member)
+        finally:
+            os.close(fd)
+
+    def _stream_file(self, path, member, fileobj):
+        fd = self._open(path)
+        try:
+            for chunk in iter(lambda: fileobj.read(READ_CHUNK), b""):
+                os.write(fd, chunk)
+            self._finish_file(fd, path, member)
+        finally:
+            os.close(fd)
+
+    def _finish_file(self, fd, path, member):
+        if self.chown:
+            _apply_owner(path, member, fd=fd)
+        os.fchmod(fd, member.mode & 0o7777)
+        os.utime(fd, (member.mtime, member.mtime))
+
+    def _write_batch(self, batch):
+        for path, member, data in batch:
+            self._write_file(path, member, data)
+
+    def _flush(self):
+        if not self.batch:
+            return
+        batch, cost = self.batch, self.batch_cost
+        self.batch, self.batch_cost = [], 0
+        self.batch_paths = set()
+        if not self.workers or self.files < PARALLEL_MIN_FILES:
+            self._write_batch(batch)
+            return
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.budget.acquire(cost)
+        future = self.pool.submit(self._write_batch, batch)
+        paths = [path for path, _, _ in batch]
+        with self.pending_lock:
+            for path in paths:
+                self.pending[path] = future
+        future.add_done_callback(lambda f: self._done(paths, cost, f))
+
+    def _done(self, paths, cost, future):
+        self.budget.release(cost)
+        with self.pending_lock:
+            for path in paths:
+                if self.pending.get(path) is future:
+                    del self.pending[path]
+        exc = future.exception()
+        if exc is not None and self.error is None:
+            self.error = exc
+
+    def _wait_for(self, path):
+        if path in self.batch_paths:
+            self._flush()
+        with self.pending_lock:
+            future = self.pending.get(path)
+        if future is not None:
+            future.result()
+
+    def _whiteout(self, path, name):
+        parent = os.path.dirname(path)
+        self._makedirs(parent)
+        if name == WHITEOUT_OPAQUE:
+            os.setxattr(parent, "trusted.overlay.opaque", b"y")
+            return
+        target = os.path.join(parent, name[len(WHITEOUT_PREFIX) :])
+        self.symlinks.pop(target, None)
+        self.hardlinks.pop(target, None)
+        self._wait_for(target)
+        self._replace(os.mknod, target, target, stat.S_IFCHR, os.makedev(0, 0))
+
+    def add(self, tar, member):
+        if self.error is not None:
+            raise self.error
+
+        path = _safe_path(self.dest, member.name)
+        if path is None:
+            return
+
+        name = os.path.basename(path)
+        if name.startswith(WHITEOUT_PREFIX):
+            self._whiteout(path, name)
+            return
+
+        if member.isdir():
+            self._makedirs(path)
+            self.dirs.append((path, member))
+            return
+
+        self._makedirs(os.path.dirname(path))
+        self.symlinks.pop(path, None)
+        self.hardlinks.pop(path, None)
+
+        if member.isreg():
+            self._wait_for(path)
+            fileobj = tar.extractfile(member)
+            if member.size > self.sync_threshold:
+                self._stream_file(path, member, fileobj)
+                return
+            self.batch.append((path, member, fileobj.read()))
+            self.files += 1
+            self.batch_paths.add(path)
+            self.batch_cost += member.size + ENTRY_OVERHEAD
+            if len(self.batch) >= BATCH_FILES or self.batch_cost >= BATCH_BYTES:
+                self._flush()
+        elif member.issym():
+            self.symlinks[path] = member
+        elif member.islnk():
+            target = _safe_path(self.dest, member.linkname)
+            if target is not None:
+                self.hardlinks[path] = target
+        elif member.isfifo():
+            self._replace(os.mkfifo, path, path, member.mode & 0o7777)
+        # Device nodes are skipped: the container gets its own /dev on tmpfs.
+
+    def finish(self):
+        self._flush()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
+
+        for path, target in self.hardlinks.items():
+            self._replace(os.link, path, target, path)
+
+        for path, member in self.symlinks.items():
+            self._replace(os.symlink, path, member.linkname, path)
+            if self.chown:
+                _apply_owner(path, member, follow=False)
+
+        # Deepest first, so restoring a parent's mode or mtime can't be undone
+        # by work on its children.
+        self.dirs.sort(key=lambda item: item[0].count(os.sep), reverse=True)
+        for path, member in self.dirs:
+            if self.chown:
+                _apply_owner(path, member)
+            os.chmod(path, member.mode & 0o7777)
+            os.utime(path, (member.mtime, member.mtime))
+
+    def abort(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def unpack(
+    image_path,
+    dest,
+    workers=DEFAULT_WORKERS,
+    max_pending_bytes=DEFAULT_MAX_PENDING_BYTES,
+):
+    dest = os.path.abspath(dest)
+    os.makedirs(dest, exist_ok=True)
+    unpacker = _Unpacker(dest, workers, max_pending_bytes)
+    try:
+        with tarfile.open(image_path) as t:
+            for member in t:
+                unpacker.add(t, member)
+                # TarFile keeps every TarInfo it has read in t.members; drop them
+                # so memory use does not grow with the number of entries.
+                t.members = []
+        unpacker.finish()
+    except BaseException:
+        unpacker.abort()
+        raise
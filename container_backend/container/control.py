@@ -0,0 +1,143 @@
+import asyncio
+import json
+import os
+import socket
+import struct
+import time
+
+# Containers report lifecycle events to the ASGI process over this socket, one
+# length-prefixed JSON message per event. Events are keyed by the launch id of
+# the main.run() process the terminal views hold: its pid plus start time, so a
+# late event for an old launch never matches a later one that reuses the pid.
+# The socket is bind-mounted into every container at the same path; only root
+# and the server's own user may send on it.
+CONTROL_SOCKET = "/tmp/mysock.socket"
+HEADER = struct.Struct("!I")
+PEERCRED = struct.Struct("3i")
+MAX_MESSAGE = 64 * 1024
+SEND_TIMEOUT = 1
+# Many containers can start at once; a full backlog makes connect() fail with
+# EAGAIN rather than wait, so senders retry until SEND_TIMEOUT.
+BACKLOG = 1024
+RETRY_INTERVAL = 0.005
+# Events nobody has waited for yet; the oldest are dropped beyond this.
+MAX_UNCLAIMED = 4096
+
+
+def launch_id(pid):
+    # None once the process has been reaped.
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            start = f.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+    return f"{pid}:{start}"
+
+
+def send_event(event, launch, path=CONTROL_SOCKET, **fields):
+    # Best effort: a container starts whether or not anyone is listening.
+    if launch is None or not os.path.exists(path):
+        return False
+    payload = json.dumps(dict(fields, event=event, launch=launch)).encode("utf-8")
+    deadline = time.monotonic() + SEND_TIMEOUT
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(SEND_TIMEOUT)
+            while True:
+                try:
+                    sock.connect(path)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise
+                    time.sleep(RETRY_INTERVAL)
+            sock.sendall(HEADER.pack(len(payload)) + payload)
+    except OSError as e:
+        print(f"Error sending {event} event: {e}")
+        return False
+    return True
+
+
+class ControlServer:
+    def __init__(self, path=CONTROL_SOCKET):
+        self.path = path
+        self.server = None
+        self.starting = None
+        self.futures = {}
+
+    async def start(self):
+        # Safe to call from every request; only the first one listens.
+        if self.starting is None:
+            self.starting = asyncio.get_running_loop().create_task(self._listen())
+        await asyncio.shield(self.starting)
+
+    async def _listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(
+            self._handle, path=self.path, backlog=BACKLOG
+        )
+        os.chmod(self.path, 0o600)
+        print(f"Control server listening on {self.path}")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            self.starting = None
+
+    def _trusted(self, writer):
+        sock = writer.get_extra_info("socket")
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+        _, uid, _ = PEERCRED.unpack(creds)
+        return uid in (0, os.getuid())
+
+    async def _handle(self, reader, writer):
+        try:
+            if not self._trusted(writer):
+                print("Rejected control connection from an untrusted user")
+                return
+            while True:
+                (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+                if size > MAX_MESSAGE:
+                    raise ValueError(f"control message too large ({size} bytes)")
+                message = json.loads(await reader.readexactly(size))
+                self.resolve(message["event"], message["launch"], message)
+        except asyncio.IncompleteReadError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Bad control message: {e}")
+        finally:
+            writer.close()
+
+    def _future(self, event, launch):
+        key = (event, launch)
+        future = self.futures.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.futures[key] = future
+        return future
+
+    def resolve(self, event, launch, message):
+        # An event may arrive before anyone waits for it; the future keeps it.
+        future = self._future(event, launch)
+        if not future.done():
+            future.set_result(message)
+        if len(self.futures) > MAX_UNCLAIMED:
+            for key in list(self.futures):
+                if self.futures[key].done():
+                    del self.futures[key]
+                if len(self.futures) <= MAX_UNCLAIMED // 2:
+                    break
+
+    async def wait(self, event, launch, timeout=None):
+        # The event's message; asyncio.TimeoutError if it doesn't come in time.
+        future = self._future(event, launch)
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+    def forget(self, launch):
+        for key in [k for k in self.futures if k[1] == launch]:
+            future = self.futures.pop(key)
+            if not future.done():
+                future.cancel()
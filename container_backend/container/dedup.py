@@ -0,0 +1,132 @@
+import errno
+import hashlib
+import os
+import stat
+
+DIGEST_XATTR = "user.containerr.sha256"
+READ_CHUNK = 1024 * 1024
+
+
+class DedupStats:
+    def __init__(self):
+        self.files = 0
+        self.hashed = 0
+        self.linked = 0
+        self.bytes_saved = 0
+
+    def __str__(self):
+        return (
+            f"scanned {self.files} files, hashed {self.hashed}, "
+            f"linked {self.linked}, saved {self.bytes_saved} bytes"
+        )
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_digest(path, st, stats=None):
+    # The digest is cached in an xattr next to the size and mtime it was computed
+    # for, so unchanged files are never read again.
+    stamp = f"{st.st_size}:{st.st_mtime_ns}:"
+    try:
+        cached = os.getxattr(path, DIGEST_XATTR, follow_symlinks=False).decode()
+        if cached.startswith(stamp):
+            return cached[len(stamp) :]
+    except OSError:
+        pass
+
+    digest = _hash_file(path)
+    if stats is not None:
+        stats.hashed += 1
+    try:
+        os.setxattr(
+            path, DIGEST_XATTR, (stamp + digest).encode(), follow_symlinks=False
+        )
+    except OSError:
+        pass
+    return digest
+
+
+class DedupStore:
+    # Objects live under <root>/<aa>/<digest>-<mode>-<uid>-<gid>. Hardlinks share
+    # an inode, so ownership and permissions are part of the key; mtimes are not.
+
+    def __init__(self, root):
+        self.root = root
+
+    def exists(self):
+        return os.path.isdir(self.root)
+
+    def _object_path(self, digest, st):
+        key = f"{digest}-{stat.S_IMODE(st.st_mode):o}-{st.st_uid}-{st.st_gid}"
+        return os.path.join(self.root, digest[:2], key)
+
+    def add_file(self, path, st, stats):
+        digest = file_digest(path, st, stats)
+        obj = self._object_path(digest, st)
+        try:
+            obj_st = os.lstat(obj)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            try:
+                os.link(path, obj)
+            except FileExistsError:
+                return self.add_file(path, st, stats)
+            return
+
+        if (obj_st.st_dev, obj_st.st_ino) == (st.st_dev, st.st_ino):
+            return
+
+        tmp = f"{path}.dedup{os.getpid()}"
+        os.link(obj, tmp)
+        try:
+            os.rename(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        stats.linked += 1
+        stats.bytes_saved += st.st_size
+
+    def dedup_tree(self, tree, stats=None, min_size=1):
+        stats = stats or DedupStats()
+        for dirpath, _, filenames in os.walk(tree):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if not stat.S_ISREG(st.st_mode) or st.st_size < min_size:
+                    continue
+                stats.files += 1
+                try:
+                    self.add_file(path, st, stats)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+        return stats
+
+    def prune(self):
+        # Objects whose only remaining link is the store's own are unreferenced.
+        removed = 0
+        if not self.exists():
+            return removed
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if os.lstat(path).st_nlink == 1:
+                    os.unlink(path)
+                    removed += 1
+        return removed
+
+    def shared_bytes(self):
+        total = 0
+        if not self.exists():
+            return total
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                st = os.lstat(os.path.join(dirpath, name))
+                total += max(0, st.st_nlink - 2) * st.st_size
+        return total
@@ -0,0 +1,135 @@
+import fcntl
+import ipaddress
+import json
+import os
+from contextlib import contextmanager
+
+IPAM_DIR = "/var/run/containerr/ipam"
+NETNS_DIR = "/var/run/netns"
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class IPAM:
+    # One state file per subnet holding a bitmap of allocated host offsets, the
+    # network namespace that owns each lease and a next-fit hint. The bitmap is
+    # a Python int, so finding the lowest free bit above the hint is a couple of
+    # big-int operations rather than a scan over every address.
+
+    def __init__(self, subnet, root=IPAM_DIR, reserved=()):
+        self.network = ipaddress.ip_network(subnet, strict=False)
+        self.size = self.network.num_addresses
+        self.root = root
+        name = f"{self.network.network_address}-{self.network.prefixlen}"
+        self.path = os.path.join(root, f"{name}.json")
+        self.lock_path = os.path.join(root, f"{name}.lock")
+        self.all_mask = (1 << self.size) - 1
+        # The network and broadcast addresses are never handed out.
+        self.reserved_mask = 1 | (1 << (self.size - 1))
+        for ip in reserved:
+            self.reserved_mask |= 1 << self._offset(ip)
+
+    def _offset(self, ip):
+        offset = int(ipaddress.ip_address(ip.split("/")[0])) - int(
+            self.network.network_address
+        )
+        if not 0 <= offset < self.size:
+            raise ValueError(f"{ip} is not in {self.network}")
+        return offset
+
+    def _address(self, offset):
+        return f"{self.network.network_address + offset}/{self.network.prefixlen}"
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {"bitmap": "0", "hint": 1, "leases": {}}
+        return {
+            "used": int(data["bitmap"], 16),
+            "hint": data["hint"],
+            "leases": data["leases"],
+        }
+
+    def _save(self, state):
+        data = {
+            "subnet": str(self.network),
+            "bitmap": format(state["used"], "x"),
+            "hint": state["hint"],
+            "leases": state["leases"],
+        }
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        _fsync_dir(self.root)
+
+    @contextmanager
+    def _state(self, write=True):
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            state = self._load()
+            yield state
+            if write:
+                self._save(state)
+        finally:
+            os.close(fd)
+
+    def _find_free(self, used, hint):
+        free = ~(used | self.reserved_mask) & self.all_mask
+        candidates = (free >> hint << hint) or free
+        if not candidates:
+            return None
+        return (candidates & -candidates).bit_length() - 1
+
+    def _reclaim(self, state):
+        # A lease is leaked once the namespace it was handed to no longer exists.
+        reclaimed = 0
+        for offset, owner in list(state["leases"].items()):
+            if not os.path.exists(os.path.join(NETNS_DIR, owner)):
+                state["used"] &= ~(1 << int(offset))
+                del state["leases"][offset]
+                reclaimed += 1
+        return reclaimed
+
+    def allocate(self, owner):
+        # owner is the network namespace the address goes to; it must already
+        # exist, or the lease looks leaked to a concurrent reclaim.
+        with self._state() as state:
+            offset = self._find_free(state["used"], state["hint"])
+            if offset is None and self._reclaim(state):
+                offset = self._find_free(state["used"], state["hint"])
+            if offset is None:
+                raise RuntimeError(f"No free address in {self.network}")
+            state["used"] |= 1 << offset
+            state["leases"][str(offset)] = owner
+            state["hint"] = (offset + 1) % self.size
+            return self._address(offset)
+
+    def free(self, ip):
+        offset = self._offset(ip)
+        with self._state() as state:
+            state["used"] &= ~(1 << offset)
+            state["leases"].pop(str(offset), None)
+
+    def reclaim(self):
+        with self._state() as state:
+            return self._reclaim(state)
+
+    def leases(self):
+        with self._state(write=False) as state:
+            return {
+                self._address(int(offset)): owner
+                for offset, owner in state["leases"].items()
+            }
@@ -1,45 +1,47 @@
+import json
+import functools
 import os
 import fnmatch
 import pty
 import shutil
-import socket
 from .networking import (
     configure_iptables,
-    container_network,
     create_bridge,
-    create_namespace,
-    create_veth_pair,
     enable_ip_forward,
     generate_gateway_ip,
-    generate_random_ip,
-    generate_random_name,
     get_active_interface,
     get_bridge_ip,
-    move_veth,
 )
 import stat
-import subprocess
-import tarfile
 import uuid
 import sys
-from .functions import FuncTools
+from .functions import FuncTools, overlay_options
+from .images import MANIFEST_SUFFIX, READONLY_FORMATS, ImageCache, load_manifest
+from .netpool import NetPool
+from . import control, tracing
 from .constants import CLONE_NEWNS, CLONE_NEWPID, CLONE_NEWUTS
 
 tools = FuncTools()
-SOCKET_ADD = "/tmp/mysock.socket"
 
 subnet = "192.168.3.0/24"
 bridge_name = "custom_bridge"
-container_ip = generate_random_ip(subnet)
 
-veth_host = generate_random_name("veth")
-gateway_ip = generate_gateway_ip(subnet)
-bridge_ip = get_bridge_ip(bridge_name)
-if not bridge_ip:
-    bridge_ip = generate_random_ip(subnet)
+
+# Both need netlink round-trips (and the interface a default route), so they are
+# resolved on first use rather than on every import.
+@functools.cache
+def get_bridge_address():
+    bridge_ip = get_bridge_ip(bridge_name)
+    if not bridge_ip:
+        bridge_ip = f"{generate_gateway_ip(subnet)}/{subnet.split('/')[1]}"
+    return bridge_ip
+
+
+@functools.cache
+def get_interface():
+    return get_active_interface()
 
 
-interface = get_active_interface()
 dir = os.getcwd()
 
 
@@ -66,6 +68,18 @@ def _get_image_path(image_name, image_dir, image_suffix="tar"):
     return os.path.join(image_dir, os.extsep.join([image_name, image_suffix]))
 
 
+def _get_image_root(image_name, image_dir):
+    cache = ImageCache(image_dir)
+    manifest = _get_image_path(image_name, image_dir, MANIFEST_SUFFIX)
+    if os.path.exists(manifest):
+        return cache.lowerdir(load_manifest(manifest))
+    for fs_type in READONLY_FORMATS:
+        fs_image = _get_image_path(image_name, image_dir, fs_type)
+        if os.path.exists(fs_image):
+            return cache.mount(image_name, fs_image, fs_type)
+    return cache.get(image_name, _get_image_path(image_name, image_dir))
+
+
 def _get_container_path(container_id, container_dir, *subdir_names):
     return os.path.join(container_dir, container_id, *subdir_names)
 
@@ -99,31 +113,11 @@ def _setup_cpu_cgroup(container_id, cpu_shares):
             f.write(str(weight))
 
 
-def send_status():
-    # All relative to containers rootdir("/")
-    socket_path = "/tmp/mysock.socket"
-
-    try:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-
-        sock.connect(socket_path)
-        print(f"Connected to Unix socket server at {SOCKET_ADD}")
-
-        message = "create_server_done"
-        sock.sendall(message.encode("utf-8"))
-        print(f"Sent message: {message}")
-
-        sock.close()
-        print("Socket connection closed.")
-
-    except Exception as e:
-        print(f"Error sending status: {e}")
-        print(f"Socket path exists: {os.path.exists(socket_path)}")
-        print(
-            f"Socket path permissions: {oct(os.stat(socket_path).st_mode)}"
-            if os.path.exists(socket_path)
-            else "Socket doesn't exist"
-        )
+def send_status(launch, container_name, container_id):
+    # Runs inside the container, where the control socket is bind-mounted at
+    # the same path as on the host, and before dropping to the container user:
+    # only root may send on it.
+    control.send_event("ready", launch, name=container_name, container_id=container_id)
 
 
 def _setup_memory_cgroup(container_id, memory, memory_swap):
@@ -155,26 +149,9 @@ def _setup_memory_cgroup(container_id, memory, memory_swap):
             f.write(str(memory_swap))
 
 
-def create_container_root(
-    image_name, image_dir, container_id, container_name, container_dir
-):
-    image_path = _get_image_path(image_name, image_dir)
-    image_root = os.path.join(image_dir, image_name, "rootfs")
-
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"Unable to locate image {image_name}")
-
-    if not os.path.exists(image_root):
-        os.makedirs(image_root)
-
-    with tarfile.open(image_path) as t:
-        members = [
-            m
-            for m in t.getmembers()
-            if m.type not in (tarfile.CHRTYPE, tarfile.BLKTYPE)
-        ]
-        t.extractall(image_root, members=members)
-
+@tracing.traced("rootfs.overlay")
+def create_container_root(image_root, container_id, container_name, container_dir):
+    # image_root is the lowerdir run() resolved in the host mount namespace.
     container_cow_rw = _get_container_path(
         f"{container_name}_{container_id}", container_dir, "cow_rs"
     )
@@ -188,15 +165,19 @@ def create_container_root(
         if not os.path.exists(d):
             os.makedirs(d)
 
+    with open(
+        _get_container_path(
+            f"{container_name}_{container_id}", container_dir, "lowerdir"
+        ),
+        "w",
+    ) as f:
+        f.write(image_root)
+
     tools.mount(
         "overlay",
         container_rootfs,
         "overlay",
-        "lowerdir={image_root},upperdir={cow_rw},workdir={cow_workdir}".format(
-            image_root=image_root,
-            cow_rw=container_cow_rw,
-            cow_workdir=container_cow_workdir,
-        ),
+        overlay_options(image_root, container_cow_rw, container_cow_workdir),
     )
     print(container_rootfs)
     return container_rootfs
@@ -217,6 +198,7 @@ def _unmount(new_root):
         print(e)
 
 
+@tracing.traced("rootfs.mounts")
 def _create_mount(new_root):
     proc_path = os.path.join(new_root, "proc")
     print(proc_path)
@@ -243,8 +225,10 @@ def _create_mount(new_root):
         if not os.path.exists(container_socket_dir):
             os.makedirs(container_socket_dir, exist_ok=True)
 
-        host_socket_path = SOCKET_ADD
-        container_socket_path = os.path.join(new_root, "tmp", "mysock.socket")
+        host_socket_path = control.CONTROL_SOCKET
+        container_socket_path = os.path.join(
+            new_root, control.CONTROL_SOCKET.lstrip("/")
+        )
         open(container_socket_path, "a").close()
 
         if os.path.exists(host_socket_path):
@@ -264,8 +248,7 @@ new_root = ""
 
 
 def contain(
-    image_name,
-    image_dir,
+    image_root,
     container_id,
     container_dir,
     cpu_shares,
@@ -275,28 +258,41 @@ def contain(
     container_name,
     netns_namespace,
     command,
+    gate=None,
+    launch=None,
 ):
     global new_root
     try:
-        tools.setns(netns_namespace)
-        _setup_cpu_cgroup(container_id, cpu_shares)
-        _setup_memory_cgroup(container_id, memory, memory_swap)
+        tracing.start_child()
+        with tracing.span("netns.join"):
+            tools.setns(netns_namespace)
+        with tracing.span("cgroup.setup"):
+            _setup_cpu_cgroup(container_id, cpu_shares)
+            _setup_memory_cgroup(container_id, memory, memory_swap)
         tools.sethostname(container_name)
-        subprocess.run(["mount", "--make-rprivate", "/"], check=True)
+        with tracing.span("mount.make_rprivate"):
+            tools.make_rprivate("/")
         new_root = create_container_root(
-            image_name, image_dir, container_id, container_name, container_dir
+            image_root, container_id, container_name, container_dir
         )
 
         _create_mount(new_root)
-        old_root = os.path.join(new_root, "old_root")
-        os.makedirs(old_root)
+        with tracing.span("rootfs.pivot_root"):
+            old_root = os.path.join(new_root, "old_root")
+            os.makedirs(old_root)
+
+            tools.pivot_root(new_root, old_root)
+
+            os.chdir("/")
 
-        tools.pivot_root(new_root, old_root)
+            tools.umount("/old_root", 2)
+            os.rmdir("/old_root")
 
-        os.chdir("/")
+        if gate is not None:
+            container_name, command = _wait_at_gate(*gate)
+            tools.sethostname(container_name)
 
-        tools.umount("/old_root", 2)
-        os.rmdir("/old_root")
+        send_status(launch, container_name, container_id)
 
         if user:
             if ":" in user:
@@ -317,12 +313,53 @@ def contain(
         os.dup2(slave, 0)  # Set stdin
         os.dup2(slave, 1)  # Set stdout
         os.dup2(slave, 2)  # Set stderr
+        tracing.flush_child()
         os.execvp(command[0], command)
     except Exception as e:
         _unmount(new_root)
         print(e)
 
 
+def _wait_at_gate(ready_fd, gate_fd):
+    # Pooled containers stop here, fully set up, until the spawner hands them
+    # out. The spawner writes the session's name and command and closes its end;
+    # EOF without a message means the container was retired from the pool.
+    os.write(ready_fd, b"R")
+    os.close(ready_fd)
+    data = b""
+    while True:
+        chunk = os.read(gate_fd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(gate_fd)
+    if not data:
+        os._exit(0)
+    message = json.loads(data)
+    return message["name"], message["command"]
+
+
+def _claimed_name(container_dir, name, container_id):
+    # A pooled container's directory is renamed to the session's name when the
+    # pool hands it out.
+    suffix = f"_{container_id}"
+    try:
+        entries = os.listdir(container_dir)
+    except OSError:
+        return name
+    for entry in entries:
+        if entry.endswith(suffix):
+            return entry[: -len(suffix)]
+    return name
+
+
+def _record_netns(container_dir, container_name, netns_namespace):
+    container_path = _get_container_path(container_name, container_dir)
+    os.makedirs(container_path, exist_ok=True)
+    with open(os.path.join(container_path, "netns"), "w") as f:
+        f.write(netns_namespace)
+
+
 def delete_container(name, container_dir):
     try:
         for dir_name in os.listdir(container_dir):
@@ -357,46 +394,78 @@ def run(
     image_dir,
     container_dir,
     command,
+    gate=None,
+    container_id=None,
 ):
-    container_id = str(uuid.uuid4())
+    # Tracing is turned on with $CONTAINERR_TRACE, best pointed at a directory
+    # since a server runs many containers.
+    tracing.reset()
+    startup = tracing.begin("run.startup", name=name, image=image_name)
+    container_id = container_id or str(uuid.uuid4())
+    # Lifecycle events are keyed by this process, which is what the terminal
+    # views hold.
+    launch = control.launch_id(os.getpid())
     flag, _, _ = check_container(container_dir, f"{name}_{container_id}")
     if flag:
         print(f"Container with name '{name}' already exists.")
         return
 
-    veth_container = f"veth{container_id[0:5]}"
-    create_bridge(bridge_name, bridge_ip)
-    create_veth_pair(veth_host, veth_container, bridge_name)
-    enable_ip_forward()
-    configure_iptables(bridge_name, interface, subnet)
-
-    netns_namespace = f"netns_{container_id}"
-    create_namespace(netns_namespace)
+    with tracing.span("network.setup"):
+        create_bridge(bridge_name, get_bridge_address())
+        enable_ip_forward()
+        configure_iptables(bridge_name, get_interface(), subnet)
 
-    move_veth(netns_namespace, veth_container)
+        net_pool = NetPool(bridge_name, get_bridge_address(), subnet)
+        with tracing.span("netns.claim"):
+            net = net_pool.claim(os.getpid(), container_id)
+        netns_namespace = net["netns"]
+        _record_netns(container_dir, f"{name}_{container_id}", netns_namespace)
 
-    container_network(netns_namespace, container_ip, veth_container, bridge_ip)
+    # Resolve (and for read-only images, mount) the image in the host mount
+    # namespace so the result is shared with every other container.
+    with tracing.span("image.resolve"):
+        image_root = _get_image_root(image_name, image_dir)
+    image_cache = ImageCache(image_dir)
 
     flags = CLONE_NEWPID | CLONE_NEWNS | CLONE_NEWUTS
-    tools.unshare(flags)
-
-    pid = os.fork()
-    if pid > 0:
-        print(pid)
-    if pid == 0:
-        contain(
-            image_name,
-            image_dir,
-            container_id,
-            container_dir,
-            cpu_share,
-            memory,
-            memory_swap,
-            user,
-            name,
-            netns_namespace,
-            command,
-        )
+    tracing.prepare_child()
+    pid, pidfd = tools.spawn(
+        flags,
+        contain,
+        image_root,
+        container_id,
+        container_dir,
+        cpu_share,
+        memory,
+        memory_swap,
+        user,
+        name,
+        netns_namespace,
+        command,
+        gate,
+        launch,
+    )
+    if gate is not None:
+        for fd in gate:
+            os.close(fd)
+    print(f"Spawned container process {pid} (pidfd {pidfd})")
+    startup.end()
+    net_pool.attach(net, pid)
+    image_cache.add_ref(image_root, container_id, pid)
+    image_cache.evict_in_background()
+    net_pool.fill_in_background()
+
+    _, status = os.waitpid(pid, 0)
+    if pidfd is not None:
+        os.close(pidfd)
+    image_cache.drop_ref(image_root, container_id)
+    net_pool.release(net)
+    tracing.write(pid)
+    if gate is not None:
+        name = _claimed_name(container_dir, name, container_id)
+    code = os.waitstatus_to_exitcode(status)
+    control.send_event("exit", launch, name=name, code=code)
+    return code
 
 
 # def execute_container(image_name, image_dir, container_name, container_dir, command):
@@ -1,30 +1,91 @@
-import random
-import iptc
-import string
-from pyroute2 import IPDB, IPRoute, netns
-from pyroute2.nslink.nslink import NetNS
+import errno
+import fcntl
+import hashlib
+import ipaddress
+import json
+import os
+import socket
+from .tracing import traced
+
+# pyroute2 and iptc are imported where they are used: importing them costs more
+# than everything else the CLI loads, and most commands never touch the network.
+
+
+class NetlinkSession:
+    # One netlink socket per namespace, kept open, with interface indexes cached
+    # by name so repeated lookups don't cost a round-trip each.
+
+    def __init__(self, netns_name=None):
+        from pyroute2 import IPRoute, NetNS
+
+        self.netns_name = netns_name
+        self.nl = NetNS(netns_name) if netns_name else IPRoute()
+        self.indexes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.nl.close()
+        self.indexes.clear()
+
+    def index(self, ifname):
+        idx = self.indexes.get(ifname)
+        if idx is None:
+            found = self.nl.link_lookup(ifname=ifname)
+            if not found:
+                raise LookupError(f"Interface {ifname} not found")
+            idx = self.indexes[ifname] = found[0]
+        return idx
+
+    def forget(self, ifname):
+        self.indexes.pop(ifname, None)
+
+    def exists(self, ifname):
+        try:
+            self.index(ifname)
+            return True
+        except LookupError:
+            return False
 
+    def link(self, command, ifname, **kwargs):
+        # Retries once with a fresh lookup if a cached index has gone stale.
+        from pyroute2 import NetlinkError
 
-def generate_random_name(prefix, length=3):
-    suffix = "".join(random.choices(string.digits, k=length))
-    return f"{prefix}{suffix}"
+        try:
+            return self.nl.link(command, index=self.index(ifname), **kwargs)
+        except NetlinkError as e:
+            if e.code != errno.ENODEV:
+                raise
+            self.forget(ifname)
+            return self.nl.link(command, index=self.index(ifname), **kwargs)
 
+    def add_address(self, ifname, cidr):
+        ip, prefix = cidr.split("/")
+        self.nl.addr("add", index=self.index(ifname), address=ip, mask=int(prefix))
 
-def generate_random_ip(subnet):
-    network, prefix = subnet.split("/")
-    prefix = int(prefix)
 
-    host_bits = 32 - prefix
-    host = random.randint(1, (1 << host_bits) - 2)
+_host_session = None
+
+
+def _reset_host_session():
+    # A forked child must not share the parent's socket: replies to one
+    # process's requests could be read by the other.
+    global _host_session
+    _host_session = None
+
+
+os.register_at_fork(after_in_child=_reset_host_session)
 
-    ip_parts = list(map(int, network.split(".")))
-    for i in range(4):
-        if host <= 0:
-            break
-        ip_parts[3 - i] |= host & 0xFF
-        host >>= 8
 
-    return f"{'.'.join(map(str, ip_parts))}/{prefix}"
+def host_session():
+    global _host_session
+    if _host_session is None:
+        _host_session = NetlinkSession()
+    return _host_session
 
 
 def generate_gateway_ip(subnet):
@@ -37,41 +98,35 @@ def generate_gateway_ip(subnet):
     return f"{'.'.join(map(str, ip_parts))}"
 
 
+@traced("net.get_bridge_ip")
 def get_bridge_ip(bridge_name):
     try:
-        with IPDB() as ipdb:
-            if bridge_name in ipdb.interfaces:
-                bridge = ipdb.interfaces[bridge_name]
-
-                if "ipaddr" in bridge:
-                    return bridge["ipaddr"][0]["address"]
+        host = host_session()
+        if not host.exists(bridge_name):
             return None
+        for addr in host.nl.get_addr(index=host.index(bridge_name), family=socket.AF_INET):
+            return addr.get_attr("IFA_ADDRESS")
+        return None
     except Exception as e:
         print(f"Error fetching IP for bridge {bridge_name}: {e}")
         return None
 
 
+@traced("net.create_bridge")
 def create_bridge(bridge_name, bridge_ip):
-    ipr = IPRoute()
+    host = host_session()
     try:
-        if not ipr.link_lookup(ifname=bridge_name):
-            ipr.link("add", ifname=bridge_name, kind="bridge")
-            ipr.link("set", index=ipr.link_lookup(ifname=bridge_name)[0], state="up")
-            ipr.addr(
-                "add",
-                index=ipr.link_lookup(ifname=bridge_name)[0],
-                address=bridge_ip.split("/")[0],
-                mask=int(bridge_ip.split("/")[1]),
-            )
+        if not host.exists(bridge_name):
+            host.nl.link("add", ifname=bridge_name, kind="bridge", state="up")
+            host.add_address(bridge_name, bridge_ip)
             print(f"Created bridge {bridge_name} with IP {bridge_ip}.")
         else:
             print(f"Bridge {bridge_name} already exists.")
     except Exception as e:
         print(f"Error creating bridge: {e}")
-    finally:
-        ipr.close()
 
 
+@traced("net.enable_ip_forward")
 def enable_ip_forward():
     try:
         with open("/proc/sys/net/ipv4/ip_forward", "w") as f:
@@ -81,102 +136,282 @@ def enable_ip_forward():
         print(f"Error enabling IP forwarding: {e}")
 
 
+@traced("net.get_active_interface")
 def get_active_interface():
-    ipr = IPRoute()
+    host = host_session()
     try:
-        routes = ipr.get_routes(dst="8.8.8.8")
+        routes = host.nl.route("get", dst="8.8.8.8")
         if routes:
-            return ipr.get_links(routes[0].get_attr("RTA_OIF"))[0].get_attr(
-                "IFLA_IFNAME"
-            )
+            oif = routes[0].get_attr("RTA_OIF")
+            ifname = host.nl.get_links(oif)[0].get_attr("IFLA_IFNAME")
+            host.indexes[ifname] = oif
+            return ifname
     except Exception as e:
         print(f"Error determining active network interface: {e}")
-    finally:
-        ipr.close()
     return None
 
 
-def rule_exists(table_name, chain_name, rule):
-    table = iptc.Table(table_name)
+# Each bridge gets its own chains, reached by one jump rule per built-in chain,
+# so the built-in chains stay the same size however many containers run.
+IPTABLES_STATE = "/var/run/containerr/iptables.json"
+CHAIN_PREFIX = "CRR"
+MAX_CHAIN_NAME = 28
+RELATED = "RELATED,ESTABLISHED"
+
+_applied_digest = None
+
+
+def _chain_name(kind, bridge_name):
+    return f"{CHAIN_PREFIX}-{kind}-{bridge_name}"[:MAX_CHAIN_NAME]
+
+
+def _spec(src=None, in_interface=None, out_interface=None, state=None, target=None):
+    return (src, in_interface, out_interface, state, target)
+
+
+def desired_iptables(bridge_name, interface, container_subnet):
+    # {(table, chain): [rule spec, ...]} for every chain this bridge needs. A
+    # chain named CRR-* is owned outright; in the built-in chains only the jump
+    # rules (and the duplicates older versions inserted) are touched.
+    subnet = str(ipaddress.ip_network(container_subnet, strict=False))
+    nat = _chain_name("NAT", bridge_name)
+    fwd = _chain_name("FWD", bridge_name)
+    inp = _chain_name("IN", bridge_name)
+    out = _chain_name("OUT", bridge_name)
+    return {
+        ("nat", "POSTROUTING"): [_spec(src=subnet, target=nat)],
+        ("nat", nat): [_spec(src=subnet, out_interface=interface, target="MASQUERADE")],
+        ("filter", "FORWARD"): [
+            _spec(in_interface=bridge_name, target=fwd),
+            _spec(out_interface=bridge_name, target=fwd),
+        ],
+        ("filter", fwd): [
+            _spec(in_interface=bridge_name, out_interface=interface, target="ACCEPT"),
+            _spec(
+                in_interface=interface,
+                out_interface=bridge_name,
+                state=RELATED,
+                target="ACCEPT",
+            ),
+        ],
+        ("filter", "INPUT"): [_spec(in_interface=bridge_name, target=inp)],
+        ("filter", inp): [_spec(in_interface=bridge_name, target="ACCEPT")],
+        ("filter", "OUTPUT"): [_spec(out_interface=bridge_name, target=out)],
+        ("filter", out): [_spec(out_interface=bridge_name, target="ACCEPT")],
+    }
+
+
+def _legacy_iptables(bridge_name, interface, container_subnet):
+    # The rules configure_iptables() used to insert into the built-in chains on
+    # every run.
+    subnet = str(ipaddress.ip_network(container_subnet, strict=False))
+    return {
+        ("nat", "POSTROUTING"): {
+            _spec(src=subnet, out_interface=interface, target="MASQUERADE")
+        },
+        ("filter", "FORWARD"): {
+            _spec(in_interface=bridge_name, out_interface=interface, target="ACCEPT"),
+            _spec(
+                in_interface=interface,
+                out_interface=bridge_name,
+                state=RELATED,
+                target="ACCEPT",
+            ),
+            _spec(in_interface=interface, out_interface=bridge_name, target="ACCEPT"),
+        },
+        ("filter", "INPUT"): {_spec(in_interface=bridge_name, target="ACCEPT")},
+        ("filter", "OUTPUT"): {_spec(out_interface=bridge_name, target="ACCEPT")},
+    }
+
+
+def _rule_spec(rule):
+    state = None
+    for match in rule.matches:
+        if match.name != "state":
+            # Not a shape this module creates, so never one of ours.
+            return None
+        state = match.state
+    src = None
+    if rule.src and not rule.src.startswith("0.0.0.0/0"):
+        src = str(ipaddress.ip_network(rule.src, strict=False))
+    target = rule.target.name if rule.target else None
+    return _spec(src, rule.in_interface, rule.out_interface, state, target)
+
+
+def _make_rule(spec):
+    import iptc
+
+    src, in_interface, out_interface, state, target = spec
+    rule = iptc.Rule()
+    if src:
+        rule.src = src
+    if in_interface:
+        rule.in_interface = in_interface
+    if out_interface:
+        rule.out_interface = out_interface
+    if state:
+        match = rule.create_match("state")
+        match.state = state
+    rule.create_target(target)
+    return rule
+
+
+def _reconcile_chain(table, chain_name, wanted, legacy, owned):
+    import iptc
+
+    changes = 0
+    if not table.is_chain(chain_name):
+        table.create_chain(chain_name)
+        changes += 1
     chain = iptc.Chain(table, chain_name)
-    for existing_rule in chain.rules:
+    seen = set()
+    for rule in chain.rules:
+        spec = _rule_spec(rule)
+        duplicate = spec in seen
+        stale = spec in legacy or (owned and spec not in wanted)
+        if duplicate or stale:
+            chain.delete_rule(rule)
+            changes += 1
+        elif spec in wanted:
+            seen.add(spec)
+    for spec in wanted:
+        if spec in seen:
+            continue
+        if owned:
+            chain.append_rule(_make_rule(spec))
+        else:
+            chain.insert_rule(_make_rule(spec))
+        changes += 1
+    return changes
+
+
+def _rules_present(desired):
+    # Read-only check that every chain and rule in desired is still installed.
+    # Reading a table is one getsockopt; only commits are expensive.
+    import iptc
+
+    for table_name in ("nat", "filter"):
+        table = iptc.Table(table_name)
+        table.refresh()
+        for (name, chain_name), wanted in desired.items():
+            if name != table_name:
+                continue
+            if not table.is_chain(chain_name):
+                return False
+            specs = {_rule_spec(rule) for rule in iptc.Chain(table, chain_name).rules}
+            if not specs.issuperset(wanted):
+                return False
+    return True
+
+
+def reconcile_iptables(bridge_name, interface, container_subnet, force=False):
+    # Returns the number of rules added or removed. The digest of the last rule
+    # set applied is kept on tmpfs, so a host reboot (which flushes netfilter)
+    # also forgets it. A matching digest is only trusted while the rules are
+    # still there: iptables -F, a firewalld reload or another tool may have
+    # removed them since. force reconciles without looking at the digest.
+    global _applied_digest
+    import iptc
+
+    desired = desired_iptables(bridge_name, interface, container_subnet)
+    digest = hashlib.sha256(repr(sorted(desired.items())).encode()).hexdigest()
+    if not force and digest == _applied_digest and _rules_present(desired):
+        return 0
+
+    os.makedirs(os.path.dirname(IPTABLES_STATE), exist_ok=True)
+    fd = os.open(f"{IPTABLES_STATE}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            with open(IPTABLES_STATE) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
         if (
-            existing_rule.src == rule.src
-            and existing_rule.out_interface == rule.out_interface
-            and existing_rule.target == rule.target
+            not force
+            and state.get(bridge_name) == digest
+            and _rules_present(desired)
         ):
-            return True
-    return False
+            _applied_digest = digest
+            return 0
+
+        legacy = _legacy_iptables(bridge_name, interface, container_subnet)
+        # Our own chains first: a jump can only be added once its target exists.
+        chains = sorted(
+            desired.items(), key=lambda item: not item[0][1].startswith(f"{CHAIN_PREFIX}-")
+        )
+        changes = 0
+        for table_name in ("nat", "filter"):
+            table = iptc.Table(table_name)
+            table.autocommit = False
+            try:
+                table.refresh()
+                table_changes = 0
+                for (name, chain_name), wanted in chains:
+                    if name != table_name:
+                        continue
+                    table_changes += _reconcile_chain(
+                        table,
+                        chain_name,
+                        wanted,
+                        legacy.get((name, chain_name), set()),
+                        chain_name.startswith(f"{CHAIN_PREFIX}-"),
+                    )
+                # One commit per table, and none at all when nothing changed.
+                if table_changes:
+                    table.commit()
+                changes += table_changes
+            finally:
+                table.autocommit = True
+
+        state[bridge_name] = digest
+        tmp_path = f"{IPTABLES_STATE}.tmp{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.rename(tmp_path, IPTABLES_STATE)
+        _applied_digest = digest
+        return changes
+    finally:
+        os.close(fd)
 
 
+@traced("net.configure_iptables")
 def configure_iptables(bridge_name, interface, container_subnet):
     try:
-        table = iptc.Table(iptc.Table.NAT)
-        chain = iptc.Chain(table, "POSTROUTING")
-        rule = iptc.Rule()
-        rule.src = container_subnet
-        rule.out_interface = interface
-        target = iptc.Target(rule, "MASQUERADE")
-        rule.target = target
-
-        chain.insert_rule(rule)
-
-        table = iptc.Table(iptc.Table.FILTER)
-        chain = iptc.Chain(table, "FORWARD")
-        rule = iptc.Rule()
-        rule.in_interface = bridge_name
-        rule.out_interface = interface
-        target = iptc.Target(rule, "ACCEPT")
-        rule.target = target
-        chain.insert_rule(rule)
-
-        rule = iptc.Rule()
-        rule.in_interface = interface
-        rule.out_interface = bridge_name
-        rule.state = "RELATED,ESTABLISHED"
-        target = iptc.Target(rule, "ACCEPT")
-        rule.target = target
-        chain.insert_rule(rule)
-
-        chain = iptc.Chain(table, "INPUT")
-        rule = iptc.Rule()
-        rule.in_interface = bridge_name
-        target = iptc.Target(rule, "ACCEPT")
-        rule.target = target
-
-        chain.insert_rule(rule)
-        chain = iptc.Chain(table, "OUTPUT")
-        rule = iptc.Rule()
-        rule.out_interface = bridge_name
-        target = iptc.Target(rule, "ACCEPT")
-        rule.target = target
-        chain.insert_rule(rule)
-
-        print("iptables rules configured successfully.")
+        changes = reconcile_iptables(bridge_name, interface, container_subnet)
+        if changes:
+            print(f"iptables rules configured successfully ({changes} changes).")
     except Exception as e:
         print(f"Error configuring iptables: {e}")
 
 
-def create_veth_pair(veth_host, veth_container, bridge_name):
-    ipr = IPRoute()
+@traced("net.create_veth_pair")
+def create_veth_pair(veth_host, veth_container, bridge_name, netns_name=None):
+    # A single request creates the pair, enslaves and raises the host end and,
+    # given a namespace, creates the peer directly inside it.
+    host = host_session()
+    peer = {"ifname": veth_container}
+    if netns_name:
+        peer["net_ns_fd"] = netns_name
     try:
-        ipr.link("add", ifname=veth_host, peer=veth_container, kind="veth")
-
-        host_index = ipr.link_lookup(ifname=veth_host)[0]
-        ipr.link("set", index=host_index, state="up")
-
-        bridge_index = ipr.link_lookup(ifname=bridge_name)[0]
-        ipr.link("set", index=host_index, master=bridge_index)
-
+        host.nl.link(
+            "add",
+            ifname=veth_host,
+            kind="veth",
+            peer=peer,
+            master=host.index(bridge_name),
+            state="up",
+        )
         print(f"Created veth pair: {veth_host} <--> {veth_container}")
         print(f"Attached {veth_host} to bridge {bridge_name}.")
     except Exception as e:
         print(f"Error creating veth pair or attaching to bridge: {e}")
-    finally:
-        ipr.close()
 
 
+@traced("net.create_namespace")
 def create_namespace(name):
+    from pyroute2 import netns
+
     try:
         netns.create(name)
         print(f"Created network namespace: {name}")
@@ -184,39 +419,51 @@ def create_namespace(name):
         print(f"Error creating network namespace {name}: {e}")
 
 
+@traced("net.move_veth")
 def move_veth(netns_name, veth_container):
+    host = host_session()
     try:
-        with IPDB() as ipdb:
-            if veth_container not in ipdb.interfaces:
-                raise ValueError(f"Interface {veth_container} does not exist.")
-
-            with ipdb.interfaces[veth_container] as veth_container_if:
-                veth_container_if.net_ns_fd = netns_name
-                print(f"Moved {veth_container} to namespace {netns_name}.")
+        host.link("set", veth_container, net_ns_fd=netns_name)
+        host.forget(veth_container)
+        print(f"Moved {veth_container} to namespace {netns_name}.")
     except Exception as e:
         print(f"Error moving {veth_container} to namespace {netns_name}: {e}")
 
 
+def _configure(ns, veth_container, container_ip, gateway):
+    ns.link("set", "lo", state="up")
+    ns.add_address(veth_container, container_ip)
+    ns.link("set", veth_container, state="up")
+    ns.nl.route(
+        "add", dst="default", gateway=gateway, oif=ns.index(veth_container)
+    )
+
+
+@traced("net.container_network")
 def container_network(netns_name, container_ip, veth_container, bridge_ip):
-    ipr = IPRoute()
+    gateway = bridge_ip.split("/")[0]
+    # Configures and checks the namespace over one netlink connection; returns
+    # whether the interface and default route are in place.
     try:
-        with IPDB(nl=NetNS(netns_name)) as ns:
-            with ns.interfaces.lo as lo:
-                lo.up()
-
-            if veth_container not in ns.interfaces:
-                raise ValueError(
-                    f"Interface {veth_container} does not exist in namespace {netns_name}."
-                )
+        with NetlinkSession(netns_name) as ns:
+            _configure(ns, veth_container, container_ip, gateway)
+            ready = ns.exists(veth_container) and bool(ns.nl.get_default_routes())
+        print(
+            f"Configured {veth_container} in {netns_name} with IP {container_ip}, gateway {gateway}"
+        )
+        return ready
+    except Exception as e:
+        print(f"Error configuring network in namespace {netns_name}: {e}")
+        return False
 
-            with ns.interfaces[veth_container] as veth_container_if:
-                veth_container_if.add_ip(container_ip)
-                veth_container_if.up()
 
-            ns.routes.add({"dst": "default", "gateway": bridge_ip}).commit()
+@traced("net.delete_namespace")
+def delete_namespace(name):
+    # Removing the last reference to a namespace destroys the veth pair with it.
+    from pyroute2 import netns
 
-        print(f"Configured network for {veth_container} in namespace {netns_name}.")
+    try:
+        netns.remove(name)
     except Exception as e:
-        print(f"Error configuring network in namespace {netns_name}: {e}")
-    finally:
-        ipr.close()
+        print(f"Error deleting network namespace {name}: {e}")
+
@@ -0,0 +1,290 @@
+import collections
+import json
+import math
+import os
+import selectors
+import time
+import uuid
+
+# A pool holds containers that have gone through the whole cold path (network,
+# cgroups, overlay, pivot_root) and are parked in contain() just before exec.
+# Containers only share a pool when everything that path depends on matches.
+PROFILE_ARGS = (
+    "image_name",
+    "image_dir",
+    "container_dir",
+    "memory",
+    "memory_swap",
+    "cpu_share",
+    "user",
+)
+POOL_NAME = "pool"
+PLACEHOLDER_COMMAND = ["/bin/sh"]
+# Pool size follows the connect rate over this window.
+RATE_WINDOW = 60
+REFILL_SAMPLES = 50
+DEFAULT_REFILL_LATENCY = 1.0
+DEFAULT_MAX_SIZE = 4
+MAX_BACKOFF = 60
+READ_CHUNK = 65536
+
+
+def profile_key(config):
+    # Empty form fields arrive as "" or None; both mean "no limit".
+    return tuple(config.get(k) or None for k in PROFILE_ARGS)
+
+
+def default_profile(image_name, app_dir):
+    return {
+        "image_name": image_name,
+        "image_dir": os.path.join(app_dir, "images/"),
+        "container_dir": os.path.join(app_dir, "containers/"),
+    }
+
+
+def load_profiles(path, app_dir):
+    with open(path) as f:
+        entries = json.load(f)
+    profiles = []
+    for entry in entries:
+        profile = default_profile(entry["image_name"], app_dir)
+        profile.update(entry)
+        profiles.append(profile)
+    return profiles
+
+
+class _Entry:
+    def __init__(self, pid, container_id, master, ready_fd, gate_fd):
+        self.pid = pid
+        self.container_id = container_id
+        self.master = master
+        self.ready_fd = ready_fd
+        self.gate_fd = gate_fd
+        self.started = time.monotonic()
+
+    def close(self):
+        for fd in (self.master, self.ready_fd, self.gate_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master = self.ready_fd = self.gate_fd = None
+
+
+class Pool:
+    def __init__(self, profile, min_size=0, max_size=DEFAULT_MAX_SIZE):
+        self.profile = {k: profile.get(k) for k in PROFILE_ARGS}
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.warming = {}
+        self.parked = collections.deque()
+        self.connects = collections.deque()
+        self.refill_times = collections.deque(maxlen=REFILL_SAMPLES)
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.backoff = 0
+        self.retry_at = 0
+
+    def size(self):
+        return len(self.parked) + len(self.warming)
+
+    def connect_rate(self, now):
+        while self.connects and now - self.connects[0] > RATE_WINDOW:
+            self.connects.popleft()
+        return len(self.connects) / RATE_WINDOW
+
+    def refill_latency(self):
+        if not self.refill_times:
+            return DEFAULT_REFILL_LATENCY
+        return sum(self.refill_times) / len(self.refill_times)
+
+    def target(self, now):
+        # Enough parked containers to cover the connects expected while one
+        # refill is in flight, plus one spare while there is any demand at all.
+        rate = self.connect_rate(now)
+        wanted = math.ceil(rate * self.refill_latency()) + (1 if rate else 0)
+        return max(self.min_size, min(self.max_size, wanted))
+
+    def stats(self, now):
+        requests = self.hits + self.misses
+        return dict(
+            self.profile,
+            parked=len(self.parked),
+            warming=len(self.warming),
+            target=self.target(now),
+            min_size=self.min_size,
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / requests if requests else None,
+            failures=self.failures,
+            connects_per_minute=self.connect_rate(now) * 60,
+            refill_ms=self.refill_latency() * 1000 if self.refill_times else None,
+            last_refill_ms=self.refill_times[-1] * 1000 if self.refill_times else None,
+        )
+
+
+class WarmPools:
+    def __init__(self, spawner):
+        self.spawner = spawner
+        self.selector = spawner.selector
+        self.pools = {}
+        self.by_pid = {}
+
+    def add(self, profile, min_size=0, max_size=DEFAULT_MAX_SIZE):
+        pool = Pool(profile, min_size, max_size)
+        self.pools[profile_key(profile)] = pool
+        return pool
+
+    def _start(self, pool):
+        ready_r, ready_w = os.pipe()
+        gate_r, gate_w = os.pipe()
+        # The pool picks the container id so a claim can find the directory.
+        container_id = str(uuid.uuid4())
+        try:
+            config = dict(
+                pool.profile,
+                name=POOL_NAME,
+                command=PLACEHOLDER_COMMAND,
+                container_id=container_id,
+            )
+            pid, master = self.spawner.spawn(config, gate=(ready_w, gate_r))
+        except BaseException:
+            for fd in (ready_r, gate_w):
+                os.close(fd)
+            raise
+        finally:
+            os.close(ready_w)
+            os.close(gate_r)
+        entry = _Entry(pid, container_id, master, ready_r, gate_w)
+        pool.warming[pid] = entry
+        self.by_pid[pid] = (pool, entry)
+        self.selector.register(ready_r, selectors.EVENT_READ, ("pool-ready", pid))
+        # Nobody reads the pty until the container is handed out; drain it so the
+        # setup output can't fill the buffer and stall the container.
+        self.selector.register(master, selectors.EVENT_READ, ("pool-drain", pid))
+
+    def _unregister(self, entry):
+        for fd in (entry.ready_fd, entry.master):
+            if fd is not None:
+                try:
+                    self.selector.unregister(fd)
+                except (KeyError, ValueError):
+                    pass
+
+    def _discard(self, pid):
+        pool, entry = self.by_pid.pop(pid, (None, None))
+        if entry is None:
+            return
+        pool.warming.pop(pid, None)
+        if entry in pool.parked:
+            pool.parked.remove(entry)
+        self._unregister(entry)
+        entry.close()
+
+    def handle_event(self, data):
+        kind, pid = data
+        pool, entry = self.by_pid.get(pid, (None, None))
+        if entry is None:
+            return
+        if kind == "pool-drain":
+            try:
+                if os.read(entry.master, READ_CHUNK):
+                    return
+            except OSError:
+                pass
+            self.selector.unregister(entry.master)
+            return
+
+        try:
+            ready = os.read(entry.ready_fd, 1) == b"R"
+        except OSError:
+            ready = False
+        self.selector.unregister(entry.ready_fd)
+        os.close(entry.ready_fd)
+        entry.ready_fd = None
+        del pool.warming[pid]
+        now = time.monotonic()
+        if ready:
+            pool.refill_times.append(now - entry.started)
+            pool.parked.append(entry)
+            pool.backoff = 0
+        else:
+            # Setup failed; back off so a broken image doesn't spin the spawner.
+            pool.failures += 1
+            pool.backoff = min(MAX_BACKOFF, (pool.backoff or 0.5) * 2)
+            pool.retry_at = now + pool.backoff
+            print(f"Pooled container {pid} failed during setup")
+            self.by_pid.pop(pid, None)
+            self._unregister(entry)
+            entry.close()
+
+    def _rename(self, pool, entry, name):
+        # The directory was created as pool_<id>; give it the session's name so
+        # delete_container(name, ...) finds it and main.run reports that name.
+        container_dir = pool.profile["container_dir"]
+        try:
+            os.rename(
+                os.path.join(container_dir, f"{POOL_NAME}_{entry.container_id}"),
+                os.path.join(container_dir, f"{name}_{entry.container_id}"),
+            )
+        except OSError as e:
+            print(f"Error renaming pooled container {entry.pid}: {e}")
+
+    def claim(self, config):
+        # Returns (pid, pty master) of a parked container now running
+        # config["command"], or None when the caller has to take the cold path.
+        pool = self.pools.get(profile_key(config))
+        if pool is None:
+            return None
+        pool.connects.append(time.monotonic())
+        message = json.dumps(
+            {"name": config["name"], "command": config["command"]}
+        ).encode("utf-8")
+        while pool.parked:
+            entry = pool.parked.popleft()
+            self.by_pid.pop(entry.pid, None)
+            self._unregister(entry)
+            try:
+                os.write(entry.gate_fd, message)
+            except OSError:
+                entry.close()
+                continue
+            os.close(entry.gate_fd)
+            entry.gate_fd = None
+            self._rename(pool, entry, config["name"])
+            pool.hits += 1
+            return entry.pid, entry.master
+        pool.misses += 1
+        return None
+
+    def forget(self, pid):
+        self._discard(pid)
+
+    def maintain(self):
+        now = time.monotonic()
+        for pool in self.pools.values():
+            target = pool.target(now)
+            if now >= pool.retry_at:
+                while pool.size() < target:
+                    try:
+                        self._start(pool)
+                    except OSError as e:
+                        print(f"Error refilling pool for {pool.profile['image_name']}: {e}")
+                        break
+            # Shrink one container per tick so a brief lull doesn't empty the pool.
+            if len(pool.parked) > target:
+                entry = pool.parked.popleft()
+                self.by_pid.pop(entry.pid, None)
+                self._unregister(entry)
+                entry.close()
+
+    def stats(self):
+        now = time.monotonic()
+        return [pool.stats(now) for pool in self.pools.values()]
+
+    def close(self):
+        for pid in list(self.by_pid):
+            self._discard(pid)
@@ -0,0 +1,195 @@
+import codecs
+import gzip
+import json
+import os
+import queue
+import re
+import secrets
+import shutil
+import threading
+import time
+
+# Terminal sessions recorded as asciicast v2. The event loop only timestamps
+# each event and puts it on a queue; a single writer thread shared by every
+# recording decodes, formats and writes them, and finished files are gzipped by
+# another thread so a large one never stalls the writer.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+FLUSH_INTERVAL = 1
+ENV = {"TERM": "xterm-256color", "SHELL": "/bin/bash"}
+# The title comes from the create form; only these characters of it make it into
+# a file name, while the header keeps it as it was.
+UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+MAX_NAME = 64
+
+
+class Recording:
+    __slots__ = ("put", "start")
+
+    def __init__(self, put):
+        self.put = put
+        self.start = time.monotonic()
+
+    def output(self, data):
+        self.put((self, time.monotonic(), "o", data))
+
+    def input(self, data):
+        self.put((self, time.monotonic(), "i", data))
+
+    def resize(self, cols, rows):
+        self.put((self, time.monotonic(), "r", f"{cols}x{rows}"))
+
+    def close(self):
+        self.put((self, time.monotonic(), "close", None))
+
+
+class _File:
+    # Writer-thread state for one recording.
+    def __init__(self, base, title, width, height):
+        self.base = base
+        self.title = title
+        self.width = width
+        self.height = height
+        self.part = 0
+        self.f = None
+        self.size = 0
+        self.start = 0
+        self.decoders = {
+            kind: codecs.getincrementaldecoder("utf-8")(errors="replace")
+            for kind in ("o", "i")
+        }
+
+    def path(self):
+        return f"{self.base}.{self.part}.cast"
+
+    def open(self, now):
+        self.f = open(self.path(), "w", encoding="utf-8", buffering=1024 * 64)
+        self.start = now
+        header = {
+            "version": 2,
+            "width": self.width,
+            "height": self.height,
+            "timestamp": int(time.time()),
+            "env": ENV,
+            "title": self.title if not self.part else f"{self.title} ({self.part})",
+        }
+        self.size = self.f.write(json.dumps(header) + "\n")
+
+    def write(self, now, kind, data):
+        if kind == "r":
+            self.width, self.height = (int(n) for n in data.split("x"))
+            text = data
+        else:
+            text = self.decoders[kind].decode(data)
+            if not text:
+                return
+        line = json.dumps([round(now - self.start, 6), kind, text]) + "\n"
+        self.size += self.f.write(line)
+
+    def finish(self):
+        path = self.path()
+        self.f.close()
+        self.f = None
+        self.part += 1
+        return path
+
+
+class Recorder:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, compress=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.events = queue.SimpleQueue()
+        self.finished = queue.SimpleQueue()
+        self.files = {}
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.threads:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            for target in (self._write_loop, self._compress_loop):
+                thread = threading.Thread(target=target, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def open(self, title, width=80, height=24):
+        self._start()
+        recording = Recording(self.events.put)
+        stem = UNSAFE_NAME.sub("_", str(title)).lstrip(".")[:MAX_NAME] or "session"
+        name = f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(4)}"
+        base = os.path.join(self.directory, name)
+        args = (base, title, width, height)
+        self.events.put((recording, recording.start, "open", args))
+        return recording
+
+    def close(self):
+        # Flushes everything queued so far and stops the threads.
+        if not self.threads:
+            return
+        self.events.put(None)
+        self.threads[0].join()
+        self.finished.put(None)
+        self.threads[1].join()
+        self.threads = []
+
+    def _write_loop(self):
+        dirty = set()
+        while True:
+            try:
+                event = self.events.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                event = ()
+            if event is None:
+                break
+            if event:
+                try:
+                    self._handle(event, dirty)
+                except (OSError, ValueError) as e:
+                    print(f"Error recording terminal: {e}")
+            # Writes are buffered; flush once things go quiet.
+            if not event or self.events.empty():
+                for f in dirty:
+                    if f.f is not None:
+                        f.f.flush()
+                dirty.clear()
+        for recording in list(self.files):
+            self._handle((recording, time.monotonic(), "close", None), dirty)
+
+    def _handle(self, event, dirty):
+        recording, now, kind, data = event
+        if kind == "open":
+            f = _File(*data)
+            f.open(now)
+            self.files[recording] = f
+            return
+        f = self.files.get(recording)
+        if f is None:
+            return
+        if kind == "close":
+            del self.files[recording]
+            dirty.discard(f)
+            self._finished(f.finish())
+            return
+        f.write(now, kind, data)
+        dirty.add(f)
+        if f.size >= self.max_bytes:
+            self._finished(f.finish())
+            f.open(now)
+
+    def _finished(self, path):
+        if self.compress:
+            self.finished.put(path)
+
+    def _compress_loop(self):
+        while True:
+            path = self.finished.get()
+            if path is None:
+                return
+            try:
+                with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.unlink(path)
+            except OSError as e:
+                print(f"Error compressing {path}: {e}")
@@ -0,0 +1,269 @@
+import asyncio
+import secrets
+import sys
+import time
+
+# Container settings go from the create form to the socket that opens the
+# terminal as a one-time token, so every browser tab gets its own container.
+CONFIG_TTL = 300
+# A session whose client drops keeps its container this long, waiting for the
+# client to come back with the session key.
+GRACE_PERIOD = 60
+SCROLLBACK_BYTES = 1024 * 64
+
+
+class Scrollback:
+    # The most recent output in a ring preallocated when the session starts;
+    # a reattaching client gets it replayed.
+    __slots__ = ("buffer", "size", "end", "full")
+
+    def __init__(self, size=SCROLLBACK_BYTES):
+        self.buffer = bytearray(size)
+        self.size = size
+        self.end = 0
+        self.full = False
+
+    def append(self, data):
+        data = memoryview(data)
+        n = len(data)
+        if n >= self.size:
+            self.buffer[:] = data[n - self.size :]
+            self.end = 0
+            self.full = True
+            return
+        first = min(n, self.size - self.end)
+        self.buffer[self.end : self.end + first] = data[:first]
+        self.buffer[: n - first] = data[first:]
+        if self.end + n >= self.size:
+            self.full = True
+        self.end = (self.end + n) % self.size
+
+    def tail(self):
+        if self.full:
+            data = bytes(self.buffer[self.end :]) + bytes(self.buffer[: self.end])
+        else:
+            data = bytes(self.buffer[: self.end])
+        # The oldest bytes may start in the middle of a UTF-8 character.
+        start = 0
+        while start < min(3, len(data)) and 0x80 <= data[start] < 0xC0:
+            start += 1
+        return data[start:]
+
+
+class Viewer:
+    # A read-only observer. lagging is set while it is too far behind to be
+    # streamed to; it gets a fresh screen once it has caught up.
+    __slots__ = ("sid", "deflate", "unacked", "lagging", "since")
+
+    def __init__(self, sid, deflate):
+        self.sid = sid
+        self.deflate = deflate
+        self.unacked = 0
+        self.lagging = False
+        self.since = 0
+
+
+class Session:
+    __slots__ = (
+        "sid",
+        "config",
+        "child_pid",
+        "launch",
+        "fd",
+        "reader",
+        "started",
+        "bytes_in",
+        "bytes_out",
+        "buffered",
+        "unacked",
+        "paused",
+        "pause",
+        "resume",
+        "key",
+        "scrollback",
+        "lock",
+        "closing",
+        "expiry",
+        "binary",
+        "deflate",
+        "watch_key",
+        "viewers",
+        "recording",
+        "lifecycle",
+        "state",
+    )
+
+    def __init__(self, sid, config):
+        self.sid = sid
+        self.config = config
+        self.child_pid = None
+        # Key of the container's events on the control socket.
+        self.launch = None
+        self.fd = None
+        self.reader = None
+        self.started = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Bytes read from the pty that have not been sent to the client yet.
+        self.buffered = 0
+        # Bytes sent that the client has not acknowledged; the reader stops
+        # reading the pty (pause/resume) while this is above the high watermark.
+        self.unacked = 0
+        self.paused = False
+        self.pause = None
+        self.resume = None
+        self.key = secrets.token_urlsafe(16)
+        self.scrollback = Scrollback()
+        # Held while output is sent, so a reattaching client's replay and the
+        # live output neither overlap nor leave a gap.
+        self.lock = asyncio.Lock()
+        # Set when the client asks to end the session rather than just dropping.
+        self.closing = False
+        self.expiry = None
+        # Raw bytes as pty_data frames instead of JSON pty_output; see
+        # views_terminal._frame.
+        self.binary = False
+        self.deflate = False
+        # Shared with observers; it only grants a read-only view.
+        self.watch_key = secrets.token_urlsafe(16)
+        self.viewers = {}
+        # A recording.Recording when sessions are being recorded.
+        self.recording = None
+        # Container state as reported over the control socket.
+        self.lifecycle = None
+        self.state = "starting"
+
+    def memory(self):
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.config)
+            + sys.getsizeof(self.scrollback.buffer)
+            + self.buffered
+        )
+
+    def stats(self):
+        return {
+            "name": self.config.get("name"),
+            "pid": self.child_pid,
+            "state": self.state,
+            "uptime": time.time() - self.started,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "buffered": self.buffered,
+            "unacked": self.unacked,
+            "paused": self.paused,
+            "attached": self.sid is not None,
+            "viewers": len(self.viewers),
+            "lagging": sum(v.lagging for v in self.viewers.values()),
+            "memory": self.memory(),
+        }
+
+
+class SessionRegistry:
+    def __init__(self):
+        self.sessions = {}
+        self.pending = {}
+        self.detached = {}
+        # Every live session by its key, attached or not.
+        self.keys = {}
+        self.watchable = {}
+        self.viewers = {}
+
+    def offer(self, config):
+        self._expire()
+        token = secrets.token_urlsafe(16)
+        self.pending[token] = (time.monotonic() + CONFIG_TTL, dict(config))
+        return token
+
+    def claim(self, token):
+        self._expire()
+        entry = self.pending.pop(token, None) if token else None
+        return entry[1] if entry else None
+
+    def _expire(self):
+        now = time.monotonic()
+        for token, (deadline, _) in list(self.pending.items()):
+            if deadline < now:
+                self.pending.pop(token, None)
+
+    def open(self, sid, config):
+        session = Session(sid, config)
+        self.sessions[sid] = session
+        self.keys[session.key] = session
+        self.watchable[session.watch_key] = session
+        return session
+
+    def get(self, sid):
+        return self.sessions.get(sid)
+
+    def close(self, sid):
+        return self.sessions.pop(sid, None)
+
+    def detach(self, session):
+        session.sid = None
+        session.unacked = 0
+        self.detached[session.key] = session
+
+    def find(self, key):
+        return self.keys.get(key) if key else None
+
+    def reattach(self, key, sid):
+        # A client that reconnects before its old transport is noticed to have
+        # dropped takes the session over from the stale sid.
+        session = self.keys.get(key) if key else None
+        if session is None:
+            return None
+        if session.sid is None:
+            self.detached.pop(key, None)
+        else:
+            self.sessions.pop(session.sid, None)
+        session.sid = sid
+        self.sessions[sid] = session
+        return session
+
+    def expire(self, session):
+        # True if the session was still detached and is now gone for good.
+        if self.detached.get(session.key) is session:
+            del self.detached[session.key]
+            return True
+        return False
+
+    def end(self, session):
+        self.keys.pop(session.key, None)
+        self.watchable.pop(session.watch_key, None)
+
+    def watch(self, watch_key, sid, deflate):
+        session = self.watchable.get(watch_key) if watch_key else None
+        if session is None:
+            return None, None
+        viewer = Viewer(sid, deflate)
+        session.viewers[sid] = viewer
+        self.viewers[sid] = session
+        return session, viewer
+
+    def viewer(self, sid):
+        session = self.viewers.get(sid)
+        if session is None:
+            return None, None
+        return session, session.viewers.get(sid)
+
+    def unwatch(self, sid):
+        session = self.viewers.pop(sid, None)
+        if session is not None:
+            session.viewers.pop(sid, None)
+        return session
+
+    def __len__(self):
+        return len(self.sessions) + len(self.detached)
+
+    def stats(self):
+        per_session = {sid: s.stats() for sid, s in list(self.sessions.items())}
+        for session in list(self.detached.values()):
+            per_session[f"detached-{session.key[:8]}"] = session.stats()
+        return {
+            "sessions": len(per_session),
+            "detached": len(self.detached),
+            "pending": len(self.pending),
+            "memory": sum(s["memory"] for s in per_session.values()),
+            "per_session": per_session,
+        }
@@ -0,0 +1,308 @@
+import json
+import os
+import pty
+import selectors
+import signal
+import socket
+import struct
+import sys
+
+import click
+
+from . import control
+from . import pool as warm_pool
+
+# The spawner is a small, long-lived root process with the container runtime
+# already imported. The ASGI server asks it to start containers over this socket
+# and gets the PTY master back as an SCM_RIGHTS fd, so the server itself never
+# forks and does not need to run as root.
+SPAWNER_SOCKET = os.environ.get(
+    "CONTAINERR_SPAWNER_SOCKET", "/run/containerr/spawner.sock"
+)
+HEADER = struct.Struct("!I")
+MAX_MESSAGE = 1024 * 1024
+
+RUN_ARGS = (
+    "name",
+    "memory",
+    "memory_swap",
+    "cpu_share",
+    "user",
+    "image_name",
+    "image_dir",
+    "container_dir",
+    "command",
+)
+
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("spawner connection closed")
+        data += chunk
+    return data
+
+
+def send_message(sock, message, fds=()):
+    payload = json.dumps(message).encode("utf-8")
+    data = HEADER.pack(len(payload)) + payload
+    if fds:
+        sent = socket.send_fds(sock, [data], list(fds))
+        data = data[sent:]
+    if data:
+        sock.sendall(data)
+
+
+def recv_message(sock, maxfds=0):
+    fds = []
+    if maxfds:
+        header, fds, _, _ = socket.recv_fds(sock, HEADER.size, maxfds)
+        if not header:
+            raise ConnectionError("spawner connection closed")
+        header += _recv_exact(sock, HEADER.size - len(header))
+    else:
+        header = _recv_exact(sock, HEADER.size)
+    (size,) = HEADER.unpack(header)
+    if size > MAX_MESSAGE:
+        raise ValueError(f"spawner message too large ({size} bytes)")
+    return json.loads(_recv_exact(sock, size)), fds
+
+
+def available(path=SPAWNER_SOCKET):
+    return os.path.exists(path)
+
+
+def _request(message, maxfds=0, path=SPAWNER_SOCKET):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        send_message(sock, message)
+        reply, fds = recv_message(sock, maxfds)
+    if not reply.get("ok"):
+        for fd in fds:
+            os.close(fd)
+        raise OSError(reply.get("error", "spawner request failed"))
+    return reply, fds
+
+
+def spawn(config, path=SPAWNER_SOCKET):
+    # Returns (pid, launch id, pty master fd) for a container started from
+    # config, which holds main.run()'s arguments by name.
+    reply, fds = _request(
+        {"op": "spawn", "config": {k: config[k] for k in RUN_ARGS}}, 1, path
+    )
+    if len(fds) != 1:
+        for fd in fds:
+            os.close(fd)
+        raise OSError("spawner did not return a pty")
+    return reply["pid"], reply.get("launch"), fds[0]
+
+
+def kill(pid, path=SPAWNER_SOCKET):
+    _request({"op": "kill", "pid": pid}, path=path)
+
+
+def stats(path=SPAWNER_SOCKET):
+    reply, _ = _request({"op": "stats"}, path=path)
+    return reply["pools"]
+
+
+def _close_fds(keep):
+    # The child must not hold the listener, other sessions' pty masters or other
+    # pooled containers' gates, or closing them in the spawner would not be seen.
+    for name in os.listdir("/proc/self/fd"):
+        fd = int(name)
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class Spawner:
+    def __init__(self, path, group=None):
+        self.path = path
+        self.group = group
+        # pid -> launch id, read while the child can't have been reaped yet.
+        self.children = {}
+        self.selector = selectors.DefaultSelector()
+        self.pools = warm_pool.WarmPools(self)
+
+    def _listen(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        if self.group is not None:
+            os.chown(self.path, -1, self.group)
+            os.chmod(self.path, 0o660)
+        else:
+            os.chmod(self.path, 0o600)
+        sock.listen(128)
+        sock.setblocking(False)
+        return sock
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            launch = self.children.pop(pid, None)
+            self.on_exit(pid, launch, os.waitstatus_to_exitcode(status))
+
+    def on_exit(self, pid, launch, exit_code):
+        self.pools.forget(pid)
+        print(f"Container process {pid} exited with status {exit_code}")
+        # main.run reports its own exit, but not when it was killed.
+        control.send_event("exit", launch, code=exit_code)
+
+    def spawn(self, config, gate=None):
+        from . import main
+
+        pid, master = pty.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _close_fds(gate or ())
+                code = (
+                    main.run(
+                        *(config[k] for k in RUN_ARGS),
+                        gate=gate,
+                        container_id=config.get("container_id"),
+                    )
+                    or 0
+                )
+            except BaseException as e:
+                print(f"Error starting container: {e}", file=sys.stderr)
+            finally:
+                os._exit(code)
+        self.children[pid] = control.launch_id(pid)
+        return pid, master
+
+    def kill(self, pid):
+        if pid not in self.children:
+            raise ProcessLookupError(f"{pid} was not started by this spawner")
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            os.kill(pid, signal.SIGKILL)
+
+    def handle(self, conn):
+        conn.settimeout(5)
+        try:
+            message, _ = recv_message(conn)
+            op = message.get("op")
+            if op == "spawn":
+                config = message["config"]
+                pid, master = self.pools.claim(config) or self.spawn(config)
+                try:
+                    reply = {"ok": True, "pid": pid, "launch": self.children.get(pid)}
+                    send_message(conn, reply, [master])
+                finally:
+                    os.close(master)
+            elif op == "kill":
+                self.kill(message["pid"])
+                send_message(conn, {"ok": True})
+            elif op == "stats":
+                send_message(conn, {"ok": True, "pools": self.pools.stats()})
+            else:
+                send_message(conn, {"ok": False, "error": f"unknown op {op!r}"})
+        except Exception as e:
+            print(f"Spawner request failed: {e}")
+            try:
+                send_message(conn, {"ok": False, "error": str(e)})
+            except OSError:
+                pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        # Preload everything a container start needs before the first request.
+        from . import main  # noqa: F401
+
+        listener = self._listen()
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        self.selector.register(listener, selectors.EVENT_READ, "accept")
+        self.selector.register(wakeup_r, selectors.EVENT_READ, "signal")
+        print(f"Spawner listening on {self.path}")
+        try:
+            while True:
+                self.pools.maintain()
+                for key, _ in self.selector.select(timeout=1):
+                    if key.data == "accept":
+                        try:
+                            conn, _ = listener.accept()
+                        except BlockingIOError:
+                            continue
+                        self.handle(conn)
+                    elif key.data == "signal":
+                        try:
+                            while os.read(wakeup_r, 512):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        self.pools.handle_event(key.data)
+                self._reap()
+        finally:
+            self.pools.close()
+            listener.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+@click.command()
+@click.option("--socket", "path", default=SPAWNER_SOCKET, help="Unix socket path")
+@click.option(
+    "--group",
+    type=int,
+    default=None,
+    help="GID allowed to use the socket (defaults to root only)",
+)
+@click.option(
+    "--pool",
+    "pool_file",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="JSON list of image/resource profiles to keep warm containers for",
+)
+@click.option(
+    "--pool-image",
+    multiple=True,
+    help="Keep warm containers for IMAGE[:MIN[:MAX]] with no resource limits",
+)
+def cli(path, group, pool_file, pool_image):
+    spawner = Spawner(path, group)
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    profiles = warm_pool.load_profiles(pool_file, app_dir) if pool_file else []
+    for spec in pool_image:
+        image_name, _, sizes = spec.partition(":")
+        min_size, _, max_size = sizes.partition(":")
+        profile = warm_pool.default_profile(image_name, app_dir)
+        profile["min"] = int(min_size or 1)
+        profile["max"] = int(max_size or max(profile["min"], warm_pool.DEFAULT_MAX_SIZE))
+        profiles.append(profile)
+    for profile in profiles:
+        spawner.pools.add(
+            profile,
+            profile.get("min", 0),
+            profile.get("max", warm_pool.DEFAULT_MAX_SIZE),
+        )
+    spawner.serve_forever()
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,3 +1,101 @@
-from django.test import TestCase
+import os
+import subprocess
+import sys
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from . import views_terminal
+from .sessions import SessionRegistry
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(APP_DIR)
+CLI_DIR = os.path.join(os.path.dirname(BACKEND_DIR), "cli")
+
+# Cumulative import time, in microseconds, for the runtime modules. Networking
+# state is resolved lazily, so importing them must not touch netlink at all.
+IMPORT_BUDGET_US = 300_000
+LAZY_MODULES = ("pyroute2", "iptc")
+
+
+def import_times(module, cwd):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            continue
+    return times
+
+
+class ImportTimeTests(SimpleTestCase):
+    def assert_fast_import(self, module, cwd):
+        times = import_times(module, cwd)
+        for lazy in LAZY_MODULES:
+            self.assertNotIn(lazy, times, f"importing {module} imports {lazy}")
+        self.assertLess(times[module], IMPORT_BUDGET_US)
+
+    def test_backend_main(self):
+        self.assert_fast_import("container.main", BACKEND_DIR)
+
+    def test_cli_main(self):
+        self.assert_fast_import("main", CLI_DIR)
+
+
+class ReattachTests(SimpleTestCase):
+    def test_reattach_while_still_attached(self):
+        registry = SessionRegistry()
+        session = registry.open("old", {"name": "box"})
+        self.assertIs(registry.find(session.key), session)
+        self.assertIs(registry.reattach(session.key, "new"), session)
+        self.assertEqual(session.sid, "new")
+        self.assertIsNone(registry.get("old"))
+        self.assertIs(registry.get("new"), session)
+        self.assertEqual(len(registry), 1)
+
+    def test_reattach_after_detach(self):
+        registry = SessionRegistry()
+        session = registry.open("old", {"name": "box"})
+        registry.close("old")
+        registry.detach(session)
+        self.assertIs(registry.reattach(session.key, "new"), session)
+        self.assertFalse(registry.detached)
+        self.assertIs(registry.get("new"), session)
+
+    def test_ended_session_cannot_be_resumed(self):
+        registry = SessionRegistry()
+        session = registry.open("old", {"name": "box"})
+        registry.close("old")
+        registry.end(session)
+        self.assertIsNone(registry.find(session.key))
+        self.assertIsNone(registry.reattach(session.key, "new"))
+
+    async def test_connect_takes_over_stale_sid(self):
+        registry = SessionRegistry()
+        session = registry.open("old", {"name": "box"})
+        session.scrollback.append(b"$ ")
+        sio = views_terminal.sio
+        emit = mock.AsyncMock()
+        disconnect = mock.AsyncMock()
+        with mock.patch.object(
+            views_terminal, "sessions", registry
+        ), mock.patch.multiple(sio, emit=emit, disconnect=disconnect):
+            await views_terminal.connect("new", {}, {"resume": session.key})
+            # The old transport's disconnect arriving late must not detach it.
+            await views_terminal.disconnect("old")
+        disconnect.assert_awaited_once_with("old")
+        self.assertIs(registry.get("new"), session)
+        self.assertFalse(registry.detached)
+        event, data = emit.await_args_list[0].args
+        self.assertEqual((event, data["output"]), ("pty_output", "$ "))
+        self.assertEqual(emit.await_args_list[0].kwargs, {"to": "new"})
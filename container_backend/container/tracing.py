@@ -0,0 +1,211 @@
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+# Spans are kept as tuples in a plain list and only turned into Chrome trace
+# events when the trace is written; with tracing off, span() returns a shared
+# no-op object.
+TRACE_ENV = "CONTAINERR_TRACE"
+
+_path = os.environ.get(TRACE_ENV) or None
+_events = []
+_child_path = None
+_child_fd = None
+
+
+class _Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.end()
+        return False
+
+    def end(self):
+        _events.append(
+            (
+                self.name,
+                self.start,
+                time.monotonic_ns(),
+                os.getpid(),
+                threading.get_native_id(),
+                self.args,
+            )
+        )
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def end(self):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable(path):
+    global _path
+    _path = os.path.abspath(path)
+
+
+def enabled():
+    return _path is not None
+
+
+def reset():
+    del _events[:]
+
+
+def span(name, **args):
+    if _path is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def begin(name, **args):
+    # For phases that don't fit a with block; call .end() on the result.
+    return span(name, **args).__enter__()
+
+
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _path is None:
+                return func(*args, **kwargs)
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _to_chrome(event):
+    name, start, end, pid, tid, args = event
+    return {
+        "name": name,
+        "cat": name.split(".")[0],
+        "ph": "X",
+        "ts": start / 1000,
+        "dur": (end - start) / 1000,
+        "pid": pid,
+        "tid": tid,
+        "args": args,
+    }
+
+
+def prepare_child():
+    # Called in the parent before spawning; the child inherits the path.
+    global _child_path
+    if _path is None:
+        return
+    if os.path.isdir(_path):
+        _child_path = os.path.join(_path, f".child-{os.getpid()}")
+    else:
+        _child_path = f"{_path}.{os.getpid()}"
+
+
+def start_child():
+    # First thing in the child: drop the parent's spans it inherited and open
+    # the sink while the host filesystem is still reachable (pivot_root hides it).
+    global _child_fd
+    if _child_path is None:
+        return
+    reset()
+    _child_fd = os.open(
+        _child_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644
+    )
+
+
+def flush_child():
+    # Last thing before exec.
+    global _child_fd
+    if _child_fd is None:
+        return
+    data = json.dumps([_to_chrome(e) for e in _events]).encode("utf-8")
+    view = memoryview(data)
+    while view:
+        view = view[os.write(_child_fd, view) :]
+    os.close(_child_fd)
+    _child_fd = None
+
+
+def _output_path():
+    # A directory collects one file per run, for summarize().
+    if os.path.isdir(_path):
+        return os.path.join(_path, f"trace-{os.getpid()}-{time.time_ns()}.json")
+    return _path
+
+
+def write(child_pid=None):
+    # Merges the child's spans (re-labelled with its host pid; inside its pid
+    # namespace it is pid 1) and writes Chrome trace JSON.
+    if _path is None:
+        return None
+    events = [_to_chrome(e) for e in _events]
+    if _child_path is not None:
+        try:
+            with open(_child_path) as f:
+                child_events = json.load(f)
+            os.unlink(_child_path)
+        except (OSError, ValueError):
+            child_events = []
+        for event in child_events:
+            if child_pid is not None:
+                event["pid"] = child_pid
+            events.append(event)
+
+    processes = {os.getpid(): "run"}
+    if child_pid is not None:
+        processes[child_pid] = "container"
+    for pid, label in processes.items():
+        events.append(
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": label}}
+        )
+
+    path = _output_path()
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.rename(tmp_path, path)
+    return path
+
+
+def _percentile(values, q):
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def summarize(paths):
+    # [(span name, count, p50 ms, p99 ms)] across every trace file given,
+    # slowest p50 first.
+    durations = {}
+    for path in paths:
+        with open(path) as f:
+            data = json.load(f)
+        for event in data.get("traceEvents", []):
+            if event.get("ph") == "X":
+                durations.setdefault(event["name"], []).append(event["dur"] / 1000)
+    rows = []
+    for name, values in durations.items():
+        values.sort()
+        rows.append(
+            (name, len(values), _percentile(values, 0.5), _percentile(values, 0.99))
+        )
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows
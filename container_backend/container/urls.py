@@ -6,6 +6,11 @@ urlpatterns = [
     path("containers/create/", views.create_container_view, name="create_container"),
     path("containers/delete/", views.delete_container_view, name="delete_container"),
     path("containers/terminal/", views_terminal.index, name="terminal"),
+    path(
+        "containers/terminal/stats/",
+        views_terminal.terminal_stats,
+        name="terminal_stats",
+    ),
     path("containers/monitor/", views.monitor_container, name="monitor_container"),
     path("", views.home, name="home page"),
 ]
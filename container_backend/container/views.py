@@ -1,54 +1,15 @@
 import os
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
-import socket
 from django.shortcuts import render, redirect
 from .main import delete_container, run
 from .form import ContainerForm, DeleteContainerForm, ExecuteContainerForm
-import threading
-
-
-SOCKET_ADD = "/tmp/mysock.socket"
-server_ready = threading.Event()
 
 
 def home(request):
     return render(request, "home_page.html")
 
 
-def start_unix_server():
-    if os.path.exists(SOCKET_ADD):
-        os.unlink(SOCKET_ADD)
-
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    print(f"Starting on {SOCKET_ADD}")
-    server_ready.set()
-    try:
-        sock.bind(SOCKET_ADD)
-        sock.listen(1)
-        print("Server is listening...")
-
-        while True:
-            print("Waiting for connection...")
-            conn, client_add = sock.accept()
-            print(f"Received connection from {client_add}")
-
-            try:
-                while True:
-                    data = conn.recv(108).decode("utf-8")
-                    if not data:
-                        break
-                    print(f"Received: {data}")
-                    if data == "create_server_done":
-                        print("Container created")
-            except Exception as e:
-                print(f"Error: {e}")
-            finally:
-                conn.close()
-    except Exception as e:
-        print(f"Server error: {e}")
-
-
 app_name = __package__.split(".")[0]
 containers_created = []
 
@@ -111,7 +72,3 @@ def create_container_view(request):
             "create_container.html",
             {"form": form, "container_list": containers_created},
         )
-
-
-threading.Thread(target=start_unix_server, daemon=True).start()
-server_ready.wait()
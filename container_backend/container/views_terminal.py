@@ -1,27 +1,70 @@
 import os
 import subprocess
+from django.conf import settings
+from django.http import JsonResponse
 from django.shortcuts import render
 import socketio
 import pty
-import select
+import codecs
 import termios
 import fcntl
-from . import main
+import asyncio
+from . import main, spawner
+from .control import ControlServer
+from .recording import Recorder
+from .sessions import GRACE_PERIOD, SessionRegistry
 import struct
 import signal
+import time
+import zlib
 
 sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
-global_config = {}
+sessions = SessionRegistry()
+control = ControlServer()
+recorder = None
+if getattr(settings, "TERMINAL_RECORDING_DIR", None):
+    recorder = Recorder(
+        settings.TERMINAL_RECORDING_DIR, settings.TERMINAL_RECORDING_MAX_BYTES
+    )
 
-fd = None
-child_pid = None
+MAX_READ_BYTES = 1024 * 20
+# Output is coalesced into messages of up to FLUSH_BYTES, waiting at most
+# FLUSH_INTERVAL seconds for a burst to fill one.
+FLUSH_BYTES = 1024 * 64
+FLUSH_INTERVAL = 0.005
+# Binary frames: the first byte holds these flags, the rest is pty output,
+# deflated when it is at least DEFLATE_THRESHOLD bytes and the client asked.
+FRAME_DEFLATE = 1
+FRAME_REPLAY = 2
+DEFLATE_THRESHOLD = 1024
+DEFLATE_LEVEL = 1
+# Unacknowledged output at which the pty stops being read, and resumes.
+HIGH_WATERMARK = 1024 * 256
+LOW_WATERMARK = 1024 * 64
+# A viewer this far behind stops being streamed to; once it has caught up it
+# gets the scrollback as a fresh screen. One that stays behind for
+# VIEWER_TIMEOUT seconds is disconnected.
+VIEWER_HIGH_WATERMARK = 1024 * 512
+VIEWER_LOW_WATERMARK = 1024 * 64
+VIEWER_TIMEOUT = 30
+# How long a new container has to report in over the control socket.
+READY_TIMEOUT = 60
 
 
 def index(request):
-    global global_config
+    watch = request.GET.get("watch")
+    if watch:
+        return render(request, "terminal.html", {"watch": watch, "name": watch})
     data = request.session["data"]
-    global_config.update(data)
-    return render(request, "terminal.html")
+    return render(
+        request,
+        "terminal.html",
+        {"token": sessions.offer(data), "name": data["name"]},
+    )
+
+
+def terminal_stats(request):
+    return JsonResponse(sessions.stats())
 
 
 def set_winsize(fd, row, col, xpix=0, ypix=0):
@@ -29,90 +72,474 @@ def set_winsize(fd, row, col, xpix=0, ypix=0):
     fcntl.ioctl(fd, termios.TIOCSWINSZ, winsize)
 
 
-async def read_and_forward_pty_output():
-    global fd
-    max_read_bytes = 1024 * 20
+def _pidfd_open(pid):
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def _read_available(master):
+    # Whatever is still buffered in the pty once the child is gone.
+    data = b""
     while True:
-        await sio.sleep(0.01)
-        if fd:
-            try:
-                timeout_sec = 0
-                (data_ready, _, _) = select.select([fd], [], [], timeout_sec)
-                if data_ready:
-                    output = os.read(fd, max_read_bytes).decode()
-                    await sio.emit("pty_output", {"output": output})
-            except (OSError, TypeError) as e:
-                print(f"Error reading from PTY: {e}")
-                break
-        else:
-            print("Process killed")
+        try:
+            chunk = os.read(master, MAX_READ_BYTES)
+        except OSError:
+            return data
+        if not chunk:
+            return data
+        data += chunk
+
+
+def _throttle(session):
+    # Stop reading the pty while the client is behind; once the kernel buffer
+    # fills, the program writing to the terminal blocks instead of the server
+    # queueing its output.
+    behind = session.buffered + session.unacked
+    if not session.paused and behind >= HIGH_WATERMARK:
+        session.paused = True
+        session.pause()
+    elif session.paused and behind <= LOW_WATERMARK:
+        session.paused = False
+        session.resume()
+
+
+async def _next_batch(session, chunks, last_sent):
+    # Everything already read goes out in one emit. While output is streaming
+    # (the last batch went out less than FLUSH_INTERVAL ago) wait up to
+    # FLUSH_INTERVAL for more, so a flood becomes a few large messages; the
+    # first output after a pause is sent at once, so typing keeps its latency.
+    # Returns the bytes and None/b"" if exit/EOF ended the batch.
+    loop = asyncio.get_running_loop()
+    data = await chunks.get()
+    streaming = loop.time() - last_sent < FLUSH_INTERVAL
+    deadline = loop.time() + FLUSH_INTERVAL
+    batch = bytearray()
+    while data:
+        batch += data
+        session.buffered -= len(data)
+        if len(batch) >= FLUSH_BYTES:
+            break
+        if not chunks.empty():
+            data = chunks.get_nowait()
+            continue
+        timeout = deadline - loop.time()
+        if not streaming or timeout <= 0:
             break
+        try:
+            data = await asyncio.wait_for(chunks.get(), timeout)
+        except asyncio.TimeoutError:
+            break
+    return bytes(batch), data
+
+
+def _frame(data, deflate, flags=0):
+    if deflate and len(data) >= DEFLATE_THRESHOLD:
+        packed = zlib.compress(data, DEFLATE_LEVEL)
+        if len(packed) < len(data):
+            return bytes([flags | FRAME_DEFLATE]) + packed
+    return bytes([flags]) + data
+
+
+def _watch_room(session, deflate):
+    return f"watch-{session.watch_key}{'-z' if deflate else ''}"
+
+
+async def _fan_out(session, data):
+    # Viewers share one room per frame format, so a read is framed and encoded
+    # once however many are watching; the owner never waits on them.
+    now = time.monotonic()
+    rooms = set()
+    for viewer in list(session.viewers.values()):
+        if viewer.lagging:
+            if now - viewer.since > VIEWER_TIMEOUT:
+                sessions.unwatch(viewer.sid)
+                sio.start_background_task(sio.disconnect, viewer.sid)
+            continue
+        viewer.unacked += len(data)
+        if viewer.unacked > VIEWER_HIGH_WATERMARK:
+            viewer.lagging = True
+            viewer.since = now
+            await sio.leave_room(viewer.sid, _watch_room(session, viewer.deflate))
+            continue
+        rooms.add(viewer.deflate)
+    for deflate in rooms:
+        await sio.emit(
+            "pty_data", _frame(data, deflate), room=_watch_room(session, deflate)
+        )
+
+
+async def _resync(session, viewer):
+    # Called with session.lock held; the tail and the room's stream then
+    # neither overlap nor leave a gap.
+    data = session.scrollback.tail()
+    viewer.unacked = len(data)
+    viewer.lagging = False
+    await sio.emit(
+        "pty_data", _frame(data, viewer.deflate, FRAME_REPLAY), to=viewer.sid
+    )
+    await sio.enter_room(viewer.sid, _watch_room(session, viewer.deflate))
+
+
+async def _send(session, data, output):
+    # data is what was read from the pty; output is its text for the JSON
+    # transport, or None when the client takes raw bytes.
+    async with session.lock:
+        session.scrollback.append(data if output is None else output.encode("utf-8"))
+        if session.viewers:
+            await _fan_out(session, data)
+        if session.sid is None:
+            # Detached: kept for the replay only.
+            return
+        session.unacked += len(data)
+        if output is None:
+            await sio.emit("pty_data", _frame(data, session.deflate), to=session.sid)
+        else:
+            await sio.emit(
+                "pty_output", {"output": output, "bytes": len(data)}, to=session.sid
+            )
+
+
+async def _replay(session):
+    data = session.scrollback.tail()
+    session.unacked = len(data)
+    if session.binary:
+        frame = _frame(data, session.deflate, FRAME_REPLAY)
+        await sio.emit("pty_data", frame, to=session.sid)
+    else:
+        await sio.emit(
+            "pty_output",
+            {
+                "output": data.decode("utf-8", "replace"),
+                "bytes": len(data),
+                "replay": True,
+            },
+            to=session.sid,
+        )
+    _throttle(session)
+
+
+async def read_and_forward_pty_output(session):
+    # Reads are driven by the event loop's readiness callbacks rather than a
+    # poll, and the child's pidfd ends the session even if something else still
+    # holds the pty open.
+    loop = asyncio.get_running_loop()
+    master = session.fd
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    chunks = asyncio.Queue()
+    eof = False
+
+    def on_output():
+        nonlocal eof
+        try:
+            data = os.read(master, MAX_READ_BYTES)
+        except BlockingIOError:
+            return
+        except OSError:
+            # EIO once every slave end is closed.
+            data = b""
+        if not data:
+            eof = True
+            loop.remove_reader(master)
+        session.buffered += len(data)
+        chunks.put_nowait(data)
+        _throttle(session)
+
+    def on_exit():
+        loop.remove_reader(pidfd)
+        chunks.put_nowait(None)
+
+    def resume():
+        if not eof:
+            loop.add_reader(master, on_output)
+
+    session.pause = lambda: loop.remove_reader(master)
+    session.resume = resume
+    os.set_blocking(master, False)
+    loop.add_reader(master, on_output)
+    pidfd = _pidfd_open(session.child_pid)
+    if pidfd is not None:
+        loop.add_reader(pidfd, on_exit)
+    last_sent = 0
+    try:
+        while True:
+            data, end = await _next_batch(session, chunks, last_sent)
+            if end is None:
+                # Output read after the exit notice is still queued.
+                loop.remove_reader(master)
+                while not chunks.empty():
+                    chunk = chunks.get_nowait()
+                    session.buffered -= len(chunk)
+                    data += chunk
+                data += _read_available(master)
+            finished = not end
+            session.bytes_out += len(data)
+            if session.recording is not None and data:
+                session.recording.output(data)
+            if session.binary:
+                # xterm.js decodes; bytes split mid-character are fine.
+                if data:
+                    await _send(session, data, None)
+                    last_sent = loop.time()
+            else:
+                output = decoder.decode(data, final=finished)
+                if output:
+                    await _send(session, data, output)
+                    last_sent = loop.time()
+            _throttle(session)
+            if finished:
+                break
+        print(f"Process {session.child_pid} exited")
+        if session.sid is not None:
+            await sio.emit("pty_exit", {}, to=session.sid)
+        for deflate in (False, True):
+            await sio.emit("pty_exit", {}, room=_watch_room(session, deflate))
+    finally:
+        eof = True
+        loop.remove_reader(master)
+        if pidfd is not None:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
 
 
 @sio.event
 async def resize(sid, message):
-    if fd:
-        set_winsize(fd, message["rows"], message["cols"])
+    session = sessions.get(sid)
+    if session and session.fd is not None:
+        set_winsize(session.fd, message["rows"], message["cols"])
+        if session.recording is not None:
+            session.recording.resize(message["cols"], message["rows"])
+
+
+async def _write_input(session, data):
+    # The master is non-blocking; a large paste may not fit in one write.
+    session.bytes_in += len(data)
+    if session.recording is not None:
+        session.recording.input(data)
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(session.fd, view) :]
+        except BlockingIOError:
+            await asyncio.sleep(0.005)
 
 
 @sio.event
 async def pty_input(sid, message):
-    if fd:
-        os.write(fd, message["input"].encode())
+    session = sessions.get(sid)
+    if session and session.fd is not None:
+        await _write_input(session, message["input"].encode())
+
+
+@sio.event
+async def pty_data(sid, data):
+    session = sessions.get(sid)
+    if session and session.fd is not None:
+        await _write_input(session, data)
+
+
+@sio.event
+async def pty_ack(sid, message):
+    session = sessions.get(sid)
+    if session:
+        session.unacked = max(0, session.unacked - int(message["bytes"]))
+        _throttle(session)
+        return
+
+    session, viewer = sessions.viewer(sid)
+    if viewer is not None:
+        viewer.unacked = max(0, viewer.unacked - int(message["bytes"]))
+        if viewer.lagging and viewer.unacked <= VIEWER_LOW_WATERMARK:
+            async with session.lock:
+                if viewer.lagging:
+                    await _resync(session, viewer)
 
 
 @sio.event
 async def disconnect_request(sid):
+    session = sessions.get(sid)
+    if session:
+        session.closing = True
     await sio.disconnect(sid)
 
 
 app_name = __package__.split(".")[0]
 
 
+def _set_transport(session, auth):
+    session.binary = bool(auth.get("binary"))
+    session.deflate = session.binary and bool(auth.get("deflate"))
+
+
 @sio.event
-async def connect(sid, environ):
-    global fd, child_pid, global_config
+async def connect(sid, environ, auth=None):
+    auth = auth or {}
+    if auth.get("watch"):
+        deflate = bool(auth.get("deflate"))
+        session, viewer = sessions.watch(auth["watch"], sid, deflate)
+        if session is None:
+            raise socketio.exceptions.ConnectionRefusedError("unknown session")
+        async with session.lock:
+            await _resync(session, viewer)
+        print(f"Viewer {sid} watching {session.child_pid}")
+        return
+
+    session = sessions.find(auth.get("resume"))
+    if session is not None:
+        async with session.lock:
+            stale = session.sid
+            if sessions.reattach(session.key, sid) is session:
+                _set_transport(session, auth)
+                if session.expiry is not None:
+                    session.expiry.cancel()
+                    session.expiry = None
+                if stale is not None:
+                    # No longer registered, so its disconnect leaves the session
+                    # alone.
+                    await sio.disconnect(stale)
+                print(f"Client {sid} reattached to {session.child_pid}")
+                await _replay(session)
+                await _status(session, session.state)
+                return
 
-    if child_pid:
-        os.write(fd, b"\n")
+    config = sessions.claim(auth.get("token"))
+    if config is None:
+        raise socketio.exceptions.ConnectionRefusedError("unknown terminal token")
+    session = sessions.open(sid, config)
+    _set_transport(session, auth)
+    try:
+        await control.start()
+    except OSError as e:
+        print(f"Error starting control server: {e}")
+    await sio.emit(
+        "pty_session", {"key": session.key, "watch": session.watch_key}, to=sid
+    )
+
+    if spawner.available():
+        try:
+            session.child_pid, session.launch, session.fd = await asyncio.to_thread(
+                spawner.spawn, dict(config, command=["/bin/bash"])
+            )
+            print(f"Spawner started child process: {session.child_pid}")
+            _started(session)
+        except OSError as e:
+            print(f"Error spawning container: {e}")
+            sessions.close(sid)
+            sessions.end(session)
         return
 
     try:
         child_pid, fd = pty.fork()
         if child_pid > 0:
+            session.child_pid, session.fd = child_pid, fd
+            session.launch = control.launch_id(child_pid)
             print(f"Spawned child process: {child_pid}")
-            sio.start_background_task(read_and_forward_pty_output)
+            _started(session)
         else:
             main.run(
-                global_config["name"],
-                global_config["memory"],
-                global_config["memory_swap"],
-                global_config["cpu_share"],
-                global_config["user"],
-                global_config["image_name"],
-                global_config["image_dir"],
-                global_config["container_dir"],
+                config["name"],
+                config["memory"],
+                config["memory_swap"],
+                config["cpu_share"],
+                config["user"],
+                config["image_name"],
+                config["image_dir"],
+                config["container_dir"],
                 ["/bin/bash"],
             )
+            os._exit(0)
 
     except OSError as e:
         print(f"Error creating PTY: {e}")
-        child_pid = None
-        fd = None
+        sessions.close(sid)
+        sessions.end(session)
+
+
+def _started(session):
+    if recorder is not None:
+        session.recording = recorder.open(session.config["name"])
+    session.reader = sio.start_background_task(read_and_forward_pty_output, session)
+    session.lifecycle = sio.start_background_task(_report_lifecycle, session)
+
+
+async def _status(session, state, code=None):
+    session.state = state
+    if session.sid is not None:
+        await sio.emit(
+            "container_status", {"state": state, "code": code}, to=session.sid
+        )
+
+
+async def _report_lifecycle(session):
+    # Readiness and exit arrive on the control socket; nothing here polls.
+    if session.launch is None:
+        return
+    try:
+        await control.wait("ready", session.launch, READY_TIMEOUT)
+        await _status(session, "running")
+    except asyncio.TimeoutError:
+        print(f"Container {session.child_pid} did not report ready")
+    message = await control.wait("exit", session.launch)
+    await _status(session, "exited", message.get("code"))
+
+
+async def _end_session(session):
+    sessions.end(session)
+    if session.lifecycle is not None:
+        session.lifecycle.cancel()
+    control.forget(session.launch)
+    if session.recording is not None:
+        session.recording.close()
+        session.recording = None
+    for viewer_sid in list(session.viewers):
+        await sio.disconnect(viewer_sid)
+    if session.child_pid is None:
+        return
+
+    # The reader must drop its event loop registrations before fd closes.
+    if session.reader is not None:
+        session.reader.cancel()
+        try:
+            await session.reader
+        except asyncio.CancelledError:
+            pass
+    try:
+        if spawner.available():
+            await asyncio.to_thread(spawner.kill, session.child_pid)
+        else:
+            os.kill(session.child_pid, signal.SIGKILL)
+            await asyncio.to_thread(os.waitpid, session.child_pid, 0)
+    except OSError as e:
+        print(f"Error killing process: {e}")
+    finally:
+        os.close(session.fd)
+
+
+async def _expire_later(session):
+    await asyncio.sleep(GRACE_PERIOD)
+    if sessions.expire(session):
+        print(f"Session for {session.child_pid} expired")
+        await _end_session(session)
 
 
 @sio.event
 async def disconnect(sid):
-    global fd
-    global child_pid
+    if sessions.unwatch(sid) is not None:
+        print(f"Viewer {sid} disconnected")
+        return
 
-    if child_pid:
-        try:
-            os.kill(child_pid, signal.SIGKILL)
-            os.wait()
-        except OSError as e:
-            print(f"Error killing process: {e}")
-        finally:
-            fd = None
-            child_pid = None
-            print("Client disconnected")
+    session = sessions.close(sid)
+    if session is None:
+        return
+
+    if session.closing or session.reader is None or session.reader.done():
+        await _end_session(session)
+        print(f"Client {sid} disconnected")
+        return
+
+    # Keep the container for a while in case the client comes back.
+    sessions.detach(session)
+    _throttle(session)
+    session.expiry = sio.start_background_task(_expire_later, session)
+    print(f"Client {sid} detached, keeping {session.child_pid} for {GRACE_PERIOD}s")
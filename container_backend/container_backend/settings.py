@@ -127,5 +127,11 @@ STATIC_ROOT = os.path.join(
     "static",
 )
 
+# Web terminal sessions are recorded as asciicast v2 files in this directory
+# when it is set. A recording rotates to a new file at
+# TERMINAL_RECORDING_MAX_BYTES and finished files are gzipped.
+TERMINAL_RECORDING_DIR = os.environ.get("CONTAINERR_RECORDINGS") or None
+TERMINAL_RECORDING_MAX_BYTES = 64 * 1024 * 1024
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field